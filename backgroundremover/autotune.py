@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+from PIL import Image
+from .bg import DEVICE, Net, remove_many
+from .cpu import available_cores, set_thread_budget
+from .profiler import peak_rss
+from .video import VideoReader
+
+# spawn, like the video workers, so CUDA and the torch thread pools start clean
+context = multiprocessing.get_context("spawn")
+
+PROFILE_PATH = os.environ.get(
+    "BACKGROUNDREMOVER_PROFILE",
+    os.path.expanduser(os.path.join("~", ".u2net", "profile.json")),
+)
+
+
+def load_profile(model_name, path=PROFILE_PATH):
+    """Settings measured by ``backgroundremover autotune`` for ``model_name``
+    on this device, or an empty dict when it was not tuned."""
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profile.get(model_name, {}).get(DEVICE.type, {})
+
+
+def save_profile(model_name, settings, path=PROFILE_PATH):
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        profile = {}
+    profile.setdefault(model_name, {})[DEVICE.type] = settings
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def sample_frames(path=None, count=16, height=320):
+    """Frames to run the trials on: the first ``count`` frames of a video or
+    an image, or random frames of a 4:3 video."""
+    if path is None:
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, (height, height * 4 // 3 // 2 * 2, 3), dtype=np.uint8) for _ in range(count)]
+    if path.lower().endswith((".jpg", ".jpeg", ".png", ".heic", ".heif")):
+        image = Image.open(path).convert("RGB")
+        image = image.resize((max(2, image.width * height // image.height // 2 * 2), height))
+        return [np.asarray(image)] * count
+    frames = []
+    for frame in VideoReader(path, height, frame_limit=count):
+        frames.append(frame)
+    if not frames:
+        raise Exception(F"Could not read any frames from {path}")
+    return frames
+
+
+def trial_worker(worker_index, worker_nodes, threads, net, frames, batch_size, seconds, barrier, results):
+    set_thread_budget(worker_index, worker_nodes, threads)
+    batches = [[frames[(i + j) % len(frames)] for j in range(batch_size)] for i in range(0, len(frames), batch_size)]
+    script_net = torch.jit.trace(net, torch.as_tensor(np.stack(batches[0]), dtype=torch.float32, device=DEVICE))
+    # warm up outside the timed part, the first runs are much slower
+    remove_many(batches[0], script_net)
+
+    barrier.wait()
+    count, latencies = 0, []
+    start = time.time()
+    while time.time() - start < seconds:
+        begin = time.time()
+        remove_many(batches[len(latencies) % len(batches)], script_net)
+        latencies.append(time.time() - begin)
+        count += batch_size
+    results.put((count / (time.time() - start), float(np.median(latencies)), peak_rss()))
+
+
+def run_trial(net, frames, batch_size, worker_nodes, threads, seconds):
+    """Run ``worker_nodes`` processes doing inference on ``frames`` in
+    batches of ``batch_size`` for ``seconds`` and return the combined frame
+    rate, the median batch latency and the sum of the peak resident memory
+    of the processes."""
+    barrier = context.Barrier(worker_nodes)
+    results = context.Queue()
+    processes = [context.Process(target=trial_worker,
+                                 args=(i, worker_nodes, threads, net, frames, batch_size, seconds,
+                                       barrier, results))
+                 for i in range(worker_nodes)]
+    for process in processes:
+        process.start()
+    try:
+        measured = [results.get(timeout=seconds + 600) for _ in processes]
+    finally:
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+    return (sum(fps for fps, _, _ in measured),
+            max(latency for _, latency, _ in measured),
+            sum(rss for _, _, rss in measured))
+
+
+def total_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def autotune(model_name="u2net", frames=None, batch_sizes=(1, 2, 4, 8), worker_counts=None, thread_counts=(0,),
+             seconds=5, memory_limit=None):
+    """Time every combination of batch size, worker count and threads per
+    worker and return the results, fastest first.
+
+    ``thread_counts`` of 0 means the even share of the cores that the workers
+    get by default. A combination that uses more than ``memory_limit`` bytes
+    is dropped, and larger batches with the same workers and threads are not
+    tried after it.
+    """
+    if worker_counts is None:
+        cores = len(available_cores())
+        worker_counts = [n for n in (1, 2, 4, 8, 16) if n <= max(1, cores // 2)]
+    frames = frames or sample_frames()
+
+    net = Net(model_name)
+    net.share_memory()
+
+    results = []
+    for worker_nodes in worker_counts:
+        for threads in thread_counts:
+            for batch_size in sorted(batch_sizes):
+                fps, latency, memory = run_trial(net, frames, batch_size, worker_nodes, threads, seconds)
+                fits = memory_limit is None or memory <= memory_limit
+                print(F"workers {worker_nodes:3d}  threads {threads or 'auto':>4}  batch {batch_size:3d}  "
+                      F"{fps:8.2f} fps  {latency * 1000:8.1f} ms/batch  {memory / 2 ** 20:8.0f} MiB"
+                      + ("" if fits else "  (over the memory limit)"))
+                if not fits:
+                    break
+                results.append({
+                    "gpu_batchsize": batch_size,
+                    "worker_nodes": worker_nodes,
+                    "threads": threads,
+                    "fps": round(fps, 2),
+                    "batch_latency": round(latency, 4),
+                    "memory": memory,
+                })
+    return sorted(results, key=lambda result: -result["fps"])
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="backgroundremover autotune",
+                                 description="Time the model with different batch sizes, worker counts and threads "
+                                             "and save the fastest settings as the defaults for this machine.")
+    ap.add_argument("-m", "--model", default="u2net", choices=["u2net", "u2net_human_seg", "u2netp"],
+                    help="The model to tune.")
+    ap.add_argument("-i", "--input", default=None,
+                    help="Video or image to take the trial frames from, random frames when not given.")
+    ap.add_argument("-b", "--batchsizes", default="1,2,4,8",
+                    help="Comma separated batch sizes to try.")
+    ap.add_argument("-w", "--workers", default=None,
+                    help="Comma separated worker counts to try, defaults to powers of two up to half the cores.")
+    ap.add_argument("-th", "--threads", default="0",
+                    help="Comma separated threads per worker to try, 0 is an even share of the cores.")
+    ap.add_argument("-s", "--seconds", default=5, type=float,
+                    help="Length of every timed trial.")
+    ap.add_argument("-mem", "--memory", default=None, type=float,
+                    help="Memory limit in GB for all workers together, defaults to 80%% of the RAM.")
+    ap.add_argument("-p", "--profile", default=PROFILE_PATH,
+                    help="Profile file the best settings are written to.")
+    args = ap.parse_args(argv)
+
+    def numbers(value):
+        return [int(n) for n in value.split(",")] if value else None
+
+    memory_limit = args.memory * 2 ** 30 if args.memory else total_memory()
+    if memory_limit and not args.memory:
+        memory_limit = int(memory_limit * 0.8)
+
+    results = autotune(args.model,
+                       frames=sample_frames(args.input),
+                       batch_sizes=numbers(args.batchsizes),
+                       worker_counts=numbers(args.workers),
+                       thread_counts=numbers(args.threads),
+                       seconds=args.seconds,
+                       memory_limit=memory_limit)
+    if not results:
+        print("No combination fitted in the memory limit")
+        exit(1)
+
+    best = results[0]
+    save_profile(args.model, best, args.profile)
+    print(F"BEST: {best['worker_nodes']} workers, {best['threads'] or 'auto'} threads, batch size "
+          F"{best['gpu_batchsize']} at {best['fps']} fps, saved to {args.profile}")
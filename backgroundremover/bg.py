@@ -1,12 +1,12 @@
 import io
 import os
+import threading
 import typing
 from PIL import Image, ImageOps
 from pymatting.alpha.estimate_alpha_cf import estimate_alpha_cf
 from pymatting.foreground.estimate_foreground_ml import estimate_foreground_ml
 from pymatting.util.util import stack_images
 from scipy.ndimage.morphology import binary_erosion
-from moviepy import VideoFileClip
 import numpy as np
 import torch
 import torch.nn.functional
@@ -14,6 +14,8 @@ import torch.nn.functional
 from hsh.library.hash import Hasher
 from .u2net import detect, u2net
 from . import github
+from .profiler import stage
+from .video import VideoReader
 
 # Register HEIC format support
 try:
@@ -196,18 +198,41 @@ def naive_cutout(img, mask):
     return cutout
 
 
+# models loaded by get_model(), shared by every later call in the process
+_models = {}
+_models_lock = threading.Lock()
+
+
 def get_model(model_name):
-    if model_name == "u2netp":
-        return detect.load_model(model_name="u2netp")
-    if model_name == "u2net_human_seg":
-        return detect.load_model(model_name="u2net_human_seg")
-    else:
-        return detect.load_model(model_name="u2net")
+    if model_name not in ("u2netp", "u2net_human_seg"):
+        model_name = "u2net"
+    with _models_lock:
+        if model_name not in _models:
+            _models[model_name] = detect.load_model(model_name=model_name)
+        return _models[model_name]
 
 
-def remove(
-    data,
-    model_name="u2net",
+def load_image(data, profiler=None):
+    """Image file bytes or an array as an RGB PIL image, upright."""
+    if isinstance(data, np.ndarray):
+        with stage(profiler, "decode"):
+            return Image.fromarray(data).convert("RGB")
+    try:
+        with stage(profiler, "decode"):
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        with stage(profiler, "exif_transpose"):
+            # Handle EXIF orientation to prevent rotated images (fixes #144)
+            img = ImageOps.exif_transpose(img)
+        with stage(profiler, "convert"):
+            return img.convert("RGB")
+    except Exception as e:
+        raise ValueError(f"Invalid image input to `remove()`: {e}")
+
+
+def cutout_image(
+    img,
+    mask,
     alpha_matting=False,
     alpha_matting_foreground_threshold=240,
     alpha_matting_background_threshold=10,
@@ -216,78 +241,108 @@ def remove(
     only_mask=False,
     background_color=None,
     background_image=None,
+    profiler=None,
 ):
-    model = get_model(model_name)
-
-    if isinstance(data, np.ndarray):
-        img = Image.fromarray(data).convert("RGB")
-    else:
-        try:
-            img = Image.open(io.BytesIO(data))
-            # Handle EXIF orientation to prevent rotated images (fixes #144)
-            img = ImageOps.exif_transpose(img)
-            img = img.convert("RGB")
-        except Exception as e:
-            raise ValueError(f"Invalid image input to `remove()`: {e}")
-
-    mask = detect.predict(model, np.array(img)).convert("L")
-
+    """Cut ``img`` out with the model's ``mask`` and return it as PNG bytes,
+    the last stage of remove()."""
     # If only_mask is True, return just the mask
     if only_mask:
-        bio = io.BytesIO()
-        mask.save(bio, "PNG")
-        return bio.getbuffer()
+        with stage(profiler, "encode"):
+            bio = io.BytesIO()
+            mask.save(bio, "PNG")
+            return bio.getbuffer()
 
     if alpha_matting:
-        cutout = alpha_matting_cutout(
-            img,
-            mask,
-            alpha_matting_foreground_threshold,
-            alpha_matting_background_threshold,
-            alpha_matting_erode_structure_size,
-            alpha_matting_base_size,
-        )
+        with stage(profiler, "matting"):
+            cutout = alpha_matting_cutout(
+                img,
+                mask,
+                alpha_matting_foreground_threshold,
+                alpha_matting_background_threshold,
+                alpha_matting_erode_structure_size,
+                alpha_matting_base_size,
+            )
     else:
-        cutout = naive_cutout(img, mask)
-
-    # If background_image is specified, composite over that image
-    if background_image is not None:
-        if isinstance(background_image, np.ndarray):
-            bg = Image.fromarray(background_image).convert("RGB")
-        else:
-            try:
-                bg = Image.open(io.BytesIO(background_image))
-                # Handle EXIF orientation for background image too
-                bg = ImageOps.exif_transpose(bg)
-                bg = bg.convert("RGB")
-            except Exception as e:
-                raise ValueError(f"Invalid background image input: {e}")
-
-        # Resize background to match cutout size
-        bg = bg.resize(cutout.size, Image.LANCZOS)
-
-        if cutout.mode == 'RGBA':
-            bg.paste(cutout, mask=cutout.split()[3])
-            cutout = bg
-        else:
-            cutout = bg
-    # If background_color is specified, composite with that color
-    elif background_color is not None:
-        bg = Image.new("RGB", cutout.size, background_color)
-        if cutout.mode == 'RGBA':
-            bg.paste(cutout, mask=cutout.split()[3])
-            cutout = bg
-        else:
-            cutout = bg
-
-    bio = io.BytesIO()
-    cutout.save(bio, "PNG")
+        with stage(profiler, "mask upsample"):
+            mask = mask.resize(img.size, Image.LANCZOS)
+
+    with stage(profiler, "compositing"):
+        if not alpha_matting:
+            cutout = naive_cutout(img, mask)
+
+        # If background_image is specified, composite over that image
+        if background_image is not None:
+            if isinstance(background_image, np.ndarray):
+                bg = Image.fromarray(background_image).convert("RGB")
+            else:
+                try:
+                    bg = Image.open(io.BytesIO(background_image))
+                    # Handle EXIF orientation for background image too
+                    bg = ImageOps.exif_transpose(bg)
+                    bg = bg.convert("RGB")
+                except Exception as e:
+                    raise ValueError(f"Invalid background image input: {e}")
+
+            # Resize background to match cutout size
+            bg = bg.resize(cutout.size, Image.LANCZOS)
+
+            if cutout.mode == 'RGBA':
+                bg.paste(cutout, mask=cutout.split()[3])
+                cutout = bg
+            else:
+                cutout = bg
+        # If background_color is specified, composite with that color
+        elif background_color is not None:
+            bg = Image.new("RGB", cutout.size, background_color)
+            if cutout.mode == 'RGBA':
+                bg.paste(cutout, mask=cutout.split()[3])
+                cutout = bg
+            else:
+                cutout = bg
+
+    with stage(profiler, "encode"):
+        bio = io.BytesIO()
+        cutout.save(bio, "PNG")
 
     return bio.getbuffer()
 
 
-def iter_frames(path):
-    return VideoFileClip(path).resized(height=320).iter_frames(dtype="uint8")
+def remove(
+    data,
+    model_name="u2net",
+    alpha_matting=False,
+    alpha_matting_foreground_threshold=240,
+    alpha_matting_background_threshold=10,
+    alpha_matting_erode_structure_size=10,
+    alpha_matting_base_size=1000,
+    only_mask=False,
+    background_color=None,
+    background_image=None,
+    profiler=None,
+):
+    """Remove the background of the image ``data``, returned as PNG bytes.
+    A Profiler records the time and memory of every stage."""
+    with stage(profiler, "load model"):
+        model = get_model(model_name)
+    img = load_image(data, profiler)
+    mask = detect.predict(model, np.array(img), profiler).convert("L")
+    return cutout_image(
+        img,
+        mask,
+        alpha_matting,
+        alpha_matting_foreground_threshold,
+        alpha_matting_background_threshold,
+        alpha_matting_erode_structure_size,
+        alpha_matting_base_size,
+        only_mask,
+        background_color,
+        background_image,
+        profiler,
+    )
+
+
+def iter_frames(path, height=320):
+    return iter(VideoReader(path, height))
 
 
 @torch.no_grad()
@@ -295,3 +350,85 @@ def remove_many(image_data: typing.List[np.array], net: Net):
     image_data = np.stack(image_data)
     image_data = torch.as_tensor(image_data, dtype=torch.float32, device=DEVICE)
     return net(image_data).numpy()
+
+
+def mask_bbox(masks, threshold=128):
+    """Return the (top, bottom, left, right) box around the foreground of a
+    batch of masks, or None when no pixel is above the threshold."""
+    foreground = np.asarray(masks) > threshold
+    if foreground.ndim == 3:
+        foreground = foreground.any(axis=0)
+    rows = np.flatnonzero(foreground.any(axis=1))
+    cols = np.flatnonzero(foreground.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+
+def next_roi(masks, padding=0.5, max_area=0.6, min_size=32):
+    """Pad the foreground box of ``masks`` into the ROI for the next frames.
+
+    Returns None (full-frame inference) when nothing was found or when the
+    padded box covers so much of the frame that cropping would not help.
+    """
+    box = mask_bbox(masks)
+    if box is None:
+        return None
+    height, width = masks.shape[-2:]
+    top, bottom, left, right = box
+    pad_y = max(int((bottom - top) * padding), (min_size - (bottom - top)) // 2, 1)
+    pad_x = max(int((right - left) * padding), (min_size - (right - left)) // 2, 1)
+    top, bottom = max(top - pad_y, 0), min(bottom + pad_y, height)
+    left, right = max(left - pad_x, 0), min(right + pad_x, width)
+    if (bottom - top) * (right - left) > max_area * height * width:
+        return None
+    return top, bottom, left, right
+
+
+def roi_confidence(masks):
+    """Mean distance of the mask values from the undecided 50% level, 0..1."""
+    return float(np.abs(masks.astype(np.float32) / 127.5 - 1).mean())
+
+
+def _leaves_roi(masks, roi, frame_shape, threshold=128):
+    # foreground on a crop edge that is not also a frame edge means the object
+    # continues outside of the crop
+    top, bottom, left, right = roi
+    height, width = frame_shape
+    foreground = masks > threshold
+    return ((top > 0 and foreground[:, 0, :].any())
+            or (bottom < height and foreground[:, -1, :].any())
+            or (left > 0 and foreground[:, :, 0].any())
+            or (right < width and foreground[:, :, -1].any()))
+
+
+@torch.no_grad()
+def remove_many_roi(image_data: typing.List[np.array], net: Net, roi=None,
+                    padding=0.5, min_confidence=0.6):
+    """Like remove_many, but only run ``net`` on the ``roi`` crop of the frames.
+
+    The crop masks are pasted into full-frame masks. Inference falls back to
+    the full frames when there is no ROI, when the object leaves the ROI or
+    when the crop prediction is not confident enough. Returns the masks and
+    the ROI to use for the next batch.
+    """
+    image_data = np.stack(image_data)
+    frame_shape = image_data.shape[1:3]
+    masks = None
+
+    if roi is not None:
+        top, bottom, left, right = roi
+        crop = torch.as_tensor(image_data[:, top:bottom, left:right], dtype=torch.float32, device=DEVICE)
+        crop_masks = net(crop).numpy()
+        if (
+            mask_bbox(crop_masks) is not None
+            and roi_confidence(crop_masks) >= min_confidence
+            and not _leaves_roi(crop_masks, roi, frame_shape)
+        ):
+            masks = np.zeros(image_data.shape[:3], dtype=np.uint8)
+            masks[:, top:bottom, left:right] = crop_masks
+
+    if masks is None:
+        masks = net(torch.as_tensor(image_data, dtype=torch.float32, device=DEVICE)).numpy()
+
+    return masks, next_roi(masks, padding)
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import subprocess as sp
+from .video import VideoReader
+
+MANIFEST = "manifest.json"
+
+
+class Checkpoint:
+    """Masks of a video job saved as lossless chunks of frames, so a job that
+    died can pick up after the last complete chunk.
+
+    ``manifest.json`` records the arguments of the job and the frame range of
+    every finished chunk. A chunk is only listed once its file is complete, and
+    a manifest written for other arguments is thrown away.
+    """
+
+    def __init__(self, directory, key, width, height, framerate, chunk_frames=300):
+        self.directory = directory
+        self.key = key
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.chunk_frames = chunk_frames
+        self.chunks = []
+        # set once the masks of the whole job are saved
+        self.finished = False
+
+        manifest = self._read_manifest()
+        if manifest is not None and manifest["key"] == key:
+            self.chunks = [tuple(chunk) for chunk in manifest["chunks"]]
+            self.finished = manifest["finished"]
+        elif os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"key": self.key, "chunks": self.chunks, "finished": self.finished}, f)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def completed_frames(self):
+        """Number of frames from the start that already have masks."""
+        return self.chunks[-1][1] if self.chunks else 0
+
+    def iter_completed(self):
+        """Yield the saved masks in frame order."""
+        info = {"width": self.width, "height": self.height, "fps": 1}
+        for start, end, name in self.chunks:
+            with VideoReader(os.path.join(self.directory, name), None, info=info, pix_fmt="gray") as reader:
+                for mask in reader:
+                    yield mask
+
+    def _open_chunk(self, start):
+        name = "chunk_%010d.mkv" % start
+        command = ['ffmpeg', '-v', 'error', '-y',
+                   '-f', 'rawvideo',
+                   '-vcodec', 'rawvideo',
+                   '-s', F"{self.width}x{self.height}",
+                   '-pix_fmt', 'gray',
+                   '-r', F"{self.framerate}",
+                   '-i', '-',
+                   '-vcodec', 'ffv1',
+                   os.path.join(self.directory, name)]
+        return name, sp.Popen(command, stdin=sp.PIPE)
+
+    def _close_chunk(self, name, proc, start, end):
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise Exception(F"Could not write checkpoint chunk {name}")
+        self.chunks.append((start, end, name))
+        self._write_manifest()
+
+    def record(self, masks):
+        """Pass ``masks`` through while saving them in chunks, starting after
+        the completed frames."""
+        start = index = self.completed_frames
+        name, proc = None, None
+        try:
+            for mask in masks:
+                if proc is None:
+                    name, proc = self._open_chunk(start)
+                proc.stdin.write(mask)
+                index += 1
+                if index - start == self.chunk_frames:
+                    self._close_chunk(name, proc, start, index)
+                    start, proc = index, None
+                yield mask
+            if proc is not None:
+                self._close_chunk(name, proc, start, index)
+                proc = None
+            self.finished = True
+            self._write_manifest()
+        finally:
+            if proc is not None:
+                # an unfinished chunk is redone on the next run
+                proc.kill()
+                proc.wait()
@@ -1,11 +1,35 @@
 import argparse
+import atexit
 import os
+import sys
+import time
 from distutils.util import strtobool
-from .. import utilities
-from ..bg import remove
+from .. import daemon
+from ..profiler import Profiler, stage
+from ..video import MATTE_ENCODERS
+
+
+def shard(value):
+    """The (index, count) of --shard i/N."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(F"{value} is not of the form i/N, like 0/8")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(F"there is no shard {index} of {count}, they are 0 to {count - 1}")
+    return index, count
 
 
 def main():
+    if sys.argv[1:2] == ["daemon"]:
+        return daemon.main(sys.argv[2:])
+    if sys.argv[1:2] == ["autotune"]:
+        from .. import autotune
+        return autotune.main(sys.argv[2:])
+    if sys.argv[1:2] in (["enqueue"], ["work"]):
+        from .. import workqueue
+        return (workqueue.enqueue_main if sys.argv[1] == "enqueue" else workqueue.work_main)(sys.argv[2:])
+
     model_choices = ["u2net", "u2net_human_seg", "u2netp"]
 
     ap = argparse.ArgumentParser()
@@ -82,17 +106,17 @@ def main():
     ap.add_argument(
         "-wn",
         "--workernodes",
-        default=1,
+        default=None,
         type=int,
-        help="Number of parallel workers"
+        help="Number of parallel workers (default 1, or the value found by backgroundremover autotune)"
     )
 
     ap.add_argument(
         "-gb",
         "--gpubatchsize",
-        default=2,
+        default=None,
         type=int,
-        help="GPU batchsize"
+        help="GPU batchsize (default 2, or the value found by backgroundremover autotune)"
     )
 
     ap.add_argument(
@@ -110,6 +134,138 @@ def main():
         type=int,
         help="Limit the number of frames to process for quick testing.",
     )
+    ap.add_argument(
+        "-st",
+        "--start",
+        default=None,
+        type=str,
+        help="Only process the video from this position on, in seconds, as [HH:]MM:SS[.ms] or as a frame number followed by f (e.g. 1500f).",
+    )
+
+    ap.add_argument(
+        "-en",
+        "--end",
+        default=None,
+        type=str,
+        help="Only process the video up to this position (same formats as --start).",
+    )
+
+    ap.add_argument(
+        "-roi",
+        "--roi",
+        nargs="?",
+        const=True,
+        default=False,
+        type=lambda x: bool(strtobool(x)),
+        help="Track the object in videos and only run the model on a padded crop around the previous mask.",
+    )
+
+    ap.add_argument(
+        "-rp",
+        "--roipadding",
+        default=0.5,
+        type=float,
+        help="Padding added around the tracked object for --roi, as a fraction of its size.",
+    )
+
+    ap.add_argument(
+        "-th",
+        "--threads",
+        default=None,
+        type=int,
+        help="CPU threads per process (each video worker, or this process for images). Defaults to an even share of the cores. A running daemon keeps its own.",
+    )
+
+    ap.add_argument(
+        "--pin",
+        default=None,
+        choices=["cores", "numa"],
+        help="Pin every video worker to its own set of cores, or spread the workers over the NUMA nodes.",
+    )
+
+    ap.add_argument(
+        "-tm",
+        "--telemetry",
+        action="append",
+        default=None,
+        help="Write JSON lines with the decode, inference and encode rates and buffer depths of video jobs to this file, - for stderr. Can be given twice.",
+    )
+
+    ap.add_argument(
+        "-ti",
+        "--telemetryinterval",
+        default=5.0,
+        type=float,
+        help="Seconds between telemetry records.",
+    )
+
+    ap.add_argument(
+        "-pf",
+        "--profile",
+        action="store_true",
+        help="When done, print the time every stage took (decode, inference, compositing, encode, ...) and the peak memory to stderr.",
+    )
+
+    ap.add_argument(
+        "--profilejson",
+        default=None,
+        type=str,
+        help="Also write the --profile summary and every timed stage to this JSON file (implies --profile).",
+    )
+
+    ap.add_argument(
+        "--profiletrace",
+        default=None,
+        type=str,
+        help="Also write the timed stages as a Chrome trace to this file, for chrome://tracing or ui.perfetto.dev (implies --profile).",
+    )
+
+    ap.add_argument(
+        "-bt",
+        "--batchtimeout",
+        default=600,
+        type=float,
+        help="Restart a video worker that spends more than this many seconds on one batch, 0 to wait forever.",
+    )
+
+    ap.add_argument(
+        "-mr",
+        "--maxrestarts",
+        default=3,
+        type=int,
+        help="Give up on a video once its workers had to be restarted this many times.",
+    )
+
+    ap.add_argument(
+        "-sg",
+        "--segments",
+        default=0,
+        type=int,
+        help="Split videos into this many keyframe aligned segments, process them in parallel and join the results (-mk, -tv and -toi only).",
+    )
+
+    ap.add_argument(
+        "--hosts",
+        type=str,
+        default=None,
+        help="Comma separated ssh hosts to process video segments on, list a host twice to run two segments on it at once. Needs --shareddir.",
+    )
+
+    ap.add_argument(
+        "--shareddir",
+        type=str,
+        default=None,
+        help="Directory visible under the same path on every host, used for video segments.",
+    )
+
+    ap.add_argument(
+        "-rs",
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Save video masks in OUTPUT.checkpoint as they are made and continue from there if the same job is run again.",
+    )
+
     ap.add_argument(
         "-mk",
         "--mattekey",
@@ -119,6 +275,13 @@ def main():
         type=lambda x: bool(strtobool(x)),
         help="Output a matte key video (black/white mask for video editing). For transparent video use -tv instead.",
     )
+    ap.add_argument(
+        "-me",
+        "--matteencoder",
+        default="mpeg4",
+        choices=list(MATTE_ENCODERS),
+        help="Encoder for -mk: mpeg4 (small, lossy), ffv1 (lossless gray), x264 (lossless, fast) or y4m (raw frames).",
+    )
     ap.add_argument(
         "-tv",
         "--transparentvideo",
@@ -169,6 +332,22 @@ def main():
         help="Path to the input video or image.",
     )
 
+    ap.add_argument(
+        "-isq",
+        "--inputsequence",
+        type=str,
+        default=None,
+        help="Image sequence to process like a video: a directory of frames, a pattern like frame_%%05d.png or a glob like 'frames/*.tif'.",
+    )
+
+    ap.add_argument(
+        "-osq",
+        "--outputsequence",
+        type=str,
+        default=None,
+        help="Write the result of a video or sequence as images named by a pattern like mask_%%05d.png (-mk for masks, -tv for transparent cutouts).",
+    )
+
     ap.add_argument(
         "-bi",
         "--backgroundimage",
@@ -210,8 +389,91 @@ def main():
         help="Path to the output folder for processed files.",
     )
 
+    ap.add_argument(
+        "-sm",
+        "--stream",
+        nargs="?",
+        const="length",
+        choices=["length", "ndjson"],
+        help="Keep the model loaded and answer framed image requests on stdin with framed results on stdout "
+             "until stdin ends, see backgroundremover/stream.py for the protocol. Framing is length (default) "
+             "or ndjson.",
+    )
+
+    ap.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="Also process the files in the subfolders of the input folder, mirroring them in the output folder.",
+    )
+
+    ap.add_argument(
+        "--include",
+        action="append",
+        help="Only process the files of a folder that match this glob, like '*.png' or 'raw/*/cam1_*'. Repeatable.",
+    )
+
+    ap.add_argument(
+        "--exclude",
+        action="append",
+        help="Skip the files of a folder that match this glob. Repeatable.",
+    )
+
+    ap.add_argument(
+        "-up",
+        "--update",
+        action="store_true",
+        help="Keep a manifest of the processed files of a folder and skip the ones whose output is up to date.",
+    )
+
+    ap.add_argument(
+        "--shard",
+        type=shard,
+        default=None,
+        help="Only process shard i of N of the files of a folder, like 0/8. N runs with the same folders and "
+             "options, on as many machines, process every file once. Needs an output folder of its own.",
+    )
+
+    ap.add_argument(
+        "--shard-status",
+        nargs="?",
+        const=0,
+        type=int,
+        default=None,
+        help="Show how many files of every shard of a folder are done, and exit. Takes the number of shards, "
+             "found from the shard manifests in the output folder when left out.",
+    )
+
+    ap.add_argument(
+        "-ib",
+        "--imagebatchsize",
+        default=4,
+        type=int,
+        help="Images of a folder or of --stream requests the model runs on at once.",
+    )
+
+    ap.add_argument(
+        "-it",
+        "--imagethreads",
+        default=0,
+        type=int,
+        help="Threads that decode and threads that encode the images of a folder or --stream, 0 for one per core up to 8.",
+    )
+
+    ap.add_argument(
+        "-mb",
+        "--memorybudget",
+        default=1024,
+        type=int,
+        help="Memory in MB the images of a folder may take up between reading and writing.",
+    )
+
     args = ap.parse_args()
 
+    if (args.shard or args.shard_status is not None) and not args.input_folder:
+        print("--shard and --shard-status work on the files of an --input-folder")
+        exit(1)
+
     # Parse background color if provided
     background_color = None
     if args.background_color:
@@ -226,104 +488,277 @@ def main():
 
     # Read background image if provided
     background_image = None
-    if args.backgroundimage and args.backgroundimage.name != "-":
+    if args.backgroundimage and args.backgroundimage.name != "<stdin>":
         r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
         background_image = r(args.backgroundimage)
 
+    profiler = None
+    if args.profile or args.profilejson or args.profiletrace:
+        profiler = Profiler()
+        atexit.register(profiler.report, args.profilejson, args.profiletrace)
+
+    def thread_budget():
+        from .. import autotune
+        from ..cpu import set_thread_budget
+
+        # settings not given on the command line come from the autotune profile
+        profile = autotune.load_profile(args.model)
+        if args.workernodes is None:
+            args.workernodes = profile.get("worker_nodes", 1)
+        if args.gpubatchsize is None:
+            args.gpubatchsize = profile.get("gpu_batchsize", 2)
+        if args.threads is None:
+            args.threads = profile.get("threads", 0)
+        if args.threads or args.pin:
+            set_thread_budget(threads=args.threads, pin=args.pin)
+
+    # a single image goes to the daemon when one is running, before torch is
+    # imported, which alone takes seconds; see daemon.py. Pipe mode (stdin or
+    # stdout) always means an image.
+    single_image = not (args.stream or args.input_folder or args.inputsequence or args.outputsequence) and (
+        args.input.name == "<stdin>" or args.output.name == "<stdout>"
+        or os.path.splitext(args.input.name)[1].lower() in [".jpg", ".jpeg", ".png", ".heic", ".heif"])
+    # the daemon has a thread budget of its own, this process only needs one when it runs the model
+    if not single_image or profiler is not None or not daemon.running():
+        thread_budget()
+
+    if single_image:
+        r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
+        w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
+        with stage(profiler, "read"):
+            data = r(args.input)
+        data = daemon.remove(
+            data,
+            model_name=args.model,
+            alpha_matting=args.alpha_matting,
+            alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
+            alpha_matting_background_threshold=args.alpha_matting_background_threshold,
+            alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
+            alpha_matting_base_size=args.alpha_matting_base_size,
+            only_mask=args.only_mask,
+            background_color=background_color,
+            background_image=background_image,
+            profiler=profiler,
+        )
+        with stage(profiler, "write"):
+            w(args.output, data)
+        return
+
+    from .. import folder, segments, sequence, stream, utilities
+    from ..telemetry import Telemetry
+
     def is_video_file(filename):
-        return filename.lower().endswith((".mp4", ".mov", ".webm", ".ogg", ".gif"))
+        return filename.lower().endswith((".mp4", ".mov", ".mkv", ".webm", ".ogg", ".gif"))
 
     def is_image_file(filename):
         return filename.lower().endswith((".jpg", ".jpeg", ".png", ".heic", ".heif"))
 
+    # its files stay open across the videos of a run, closed when the run ends
+    telemetry = Telemetry(args.telemetry, args.telemetryinterval) if args.telemetry else None
+    video_options = dict(worker_nodes=args.workernodes,
+                         gpu_batchsize=args.gpubatchsize,
+                         model_name=args.model,
+                         frame_limit=args.framelimit,
+                         framerate=args.framerate,
+                         roi=args.roi,
+                         roi_padding=args.roipadding,
+                         start=args.start,
+                         end=args.end,
+                         batch_timeout=args.batchtimeout,
+                         max_restarts=args.maxrestarts,
+                         threads=args.threads,
+                         pin=args.pin,
+                         telemetry=telemetry,
+                         profiler=profiler)
+
+    def segment_args():
+        if args.mattekey:
+            cli_args = ["-mk", "-me", args.matteencoder]
+        elif args.transparentvideo:
+            cli_args = ["-tv"]
+        elif args.transparentvideooverimage:
+            cli_args = ["-toi", "-bi", os.path.abspath(args.backgroundimage.name)]
+        else:
+            print("Segmented processing only supports -mk, -tv and -toi")
+            exit(1)
+        cli_args += ["-m", args.model, "-wn", str(args.workernodes), "-gb", str(args.gpubatchsize),
+                     "-bt", str(args.batchtimeout), "-mr", str(args.maxrestarts)]
+        if args.framerate != -1:
+            cli_args += ["-fr", str(args.framerate)]
+        if args.threads:
+            cli_args += ["-th", str(args.threads)]
+        if args.roi:
+            cli_args += ["-roi", "-rp", str(args.roipadding)]
+        return cli_args
+
+    def process_video(input_path, output_path, pipeline=None, input_sequence=False, output_sequence=False):
+        options = dict(video_options)
+        if pipeline is not None:
+            options["pipeline"] = pipeline
+        if input_sequence:
+            options["input_sequence"] = True
+        if output_sequence:
+            options["output_sequence"] = True
+        if args.resume:
+            options["checkpoint_dir"] = output_path + ".checkpoint"
+
+        if args.segments > 1 or args.hosts:
+            if args.start is not None or args.end is not None:
+                print("Segmented processing does not support --start and --end")
+                exit(1)
+            # a limit, telemetry file, profile or checkpoint per segment process would not add up to one for the job
+            if args.framelimit != -1 or args.telemetry or profiler is not None or args.resume:
+                print("Segmented processing does not support --framelimit, --telemetry, --profile and --resume")
+                exit(1)
+            hosts = args.hosts.split(",") if args.hosts else None
+            segments.process_segmented(output_path, input_path, segment_args(),
+                                       args.segments if args.segments > 1 else len(hosts),
+                                       hosts=hosts,
+                                       shared_dir=args.shareddir)
+        elif args.mattekey:
+            utilities.matte_key(output_path, input_path, encoder=args.matteencoder, **options)
+        elif args.transparentvideo:
+            utilities.transparentvideo(output_path, input_path, **options)
+        elif args.transparentvideoovervideo:
+            utilities.transparentvideoovervideo(output_path, os.path.abspath(args.backgroundvideo.name),
+                                                input_path, **options)
+        elif args.transparentvideooverimage:
+            utilities.transparentvideooverimage(output_path, os.path.abspath(args.backgroundimage.name),
+                                                input_path, **options)
+        elif args.transparentgif:
+            utilities.transparentgif(output_path, input_path, **options)
+        elif args.transparentgifwithbackground:
+            utilities.transparentgifwithbackground(output_path, os.path.abspath(args.backgroundimage.name),
+                                                   input_path, **options)
+
+    if args.stream:
+        # stdout carries the results, anything printed goes to stderr
+        output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        stream.serve(sys.stdin.buffer, output, args.stream,
+                     batch_size=args.imagebatchsize,
+                     threads=args.imagethreads,
+                     model=args.model,
+                     alpha_matting=args.alpha_matting,
+                     alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
+                     alpha_matting_background_threshold=args.alpha_matting_background_threshold,
+                     alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
+                     alpha_matting_base_size=args.alpha_matting_base_size,
+                     only_mask=args.only_mask,
+                     background_color=background_color,
+                     background_image=background_image)
+        return
+
     if args.input_folder:
         input_folder = os.path.abspath(args.input_folder)
         output_folder = os.path.abspath(args.output_folder or input_folder)
         os.makedirs(output_folder, exist_ok=True)
 
-        files = [f for f in os.listdir(input_folder) if is_video_file(f) or is_image_file(f)]
-
+        # with the output folder inside the input folder, don't process the outputs again
+        skip_dirs = [output_folder] if output_folder != input_folder else []
+        files = folder.find_files(input_folder, lambda f: is_video_file(f) or is_image_file(f), args.recursive,
+                                  args.include, args.exclude, skip_dirs)
+
+        def output_for(name):
+            directory, base = os.path.split(name)
+            return os.path.join(output_folder, directory, f"output_{base}")
+
+        # the arguments that change how the outputs look, an output made with others is out of date
+        settings = {name: getattr(args, name) for name in (
+            "model", "alpha_matting", "alpha_matting_foreground_threshold", "alpha_matting_background_threshold",
+            "alpha_matting_erode_size", "alpha_matting_base_size", "only_mask", "background_color")}
+        for name in ("backgroundimage", "backgroundvideo"):
+            background = getattr(args, name)
+            settings[name] = os.path.abspath(background.name) if background and background.name != "<stdin>" else None
+        image_settings = settings
+        video_settings = dict(settings, **{name: getattr(args, name) for name in (
+            "gpubatchsize", "framerate", "framelimit", "start", "end", "roi", "roipadding", "mattekey",
+            "matteencoder", "transparentvideo", "transparentvideoovervideo", "transparentvideooverimage",
+            "transparentgif", "transparentgifwithbackground")})
+
+        def up_to_date(manifest, f):
+            return manifest.up_to_date(f, os.path.join(input_folder, f), output_for(f),
+                                       video_settings if is_video_file(f) else image_settings)
+
+        if args.shard_status is not None:
+            counts = [args.shard_status] if args.shard_status else folder.shard_counts(output_folder)
+            if not counts:
+                print(F"No shard manifests in {output_folder}, pass the number of shards")
+                exit(1)
+            for count in counts:
+                print(F"{'SHARD':>8} {'FILES':>8} {'DONE':>8} {'LEFT':>8}  UPDATED")
+                total = done = 0
+                for index in range(count):
+                    path = folder.manifest_path(output_folder, (index, count))
+                    manifest = folder.Manifest(path)
+                    names = [f for f in files if folder.shard_of(f, count) == index]
+                    finished = sum(1 for f in names if up_to_date(manifest, f))
+                    updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path))) \
+                        if os.path.exists(path) else "not started"
+                    print(F"{index:>4}/{count:<3} {len(names):>8} {finished:>8} {len(names) - finished:>8}  {updated}")
+                    total, done = total + len(names), done + finished
+                print(F"{'TOTAL':>8} {total:>8} {done:>8} {total - done:>8}")
+            return
+
+        if args.shard:
+            if output_folder == input_folder:
+                # the shards would take the outputs of the others for inputs
+                print("--shard needs an --output-folder other than the input folder")
+                exit(1)
+            files = [f for f in files if folder.shard_of(f, args.shard[1]) == args.shard[0]]
+            print(F"SHARD {args.shard[0]}/{args.shard[1]}: {len(files)} FILES")
+
+        manifest = None
+        if args.update or args.shard:
+            # a shard keeps a manifest of its own even without --update, for --shard-status
+            manifest = folder.Manifest(folder.manifest_path(output_folder, args.shard))
+        if args.update:
+            outputs = manifest.outputs
+            todo = [f for f in files if os.path.join(input_folder, f) not in outputs and not up_to_date(manifest, f)]
+            print(F"{len(files) - len(todo)} OF {len(files)} FILES ARE UP TO DATE")
+            files = todo
         for f in files:
-            input_path = os.path.join(input_folder, f)
-            output_path = os.path.join(output_folder, f"output_{f}")
-
-            if is_video_file(f):
-                if args.mattekey:
-                    utilities.matte_key(output_path, input_path,
-                                        worker_nodes=args.workernodes,
-                                        gpu_batchsize=args.gpubatchsize,
-                                        model_name=args.model,
-                                        frame_limit=args.framelimit,
-                                        framerate=args.framerate)
-                elif args.transparentvideo:
-                    utilities.transparentvideo(output_path, input_path,
-                                               worker_nodes=args.workernodes,
-                                               gpu_batchsize=args.gpubatchsize,
-                                               model_name=args.model,
-                                               frame_limit=args.framelimit,
-                                               framerate=args.framerate)
-                elif args.transparentvideoovervideo:
-                    utilities.transparentvideoovervideo(output_path, os.path.abspath(args.backgroundvideo.name),
-                                                        input_path,
-                                                        worker_nodes=args.workernodes,
-                                                        gpu_batchsize=args.gpubatchsize,
-                                                        model_name=args.model,
-                                                        frame_limit=args.framelimit,
-                                                        framerate=args.framerate)
-                elif args.transparentvideooverimage:
-                    utilities.transparentvideooverimage(output_path, os.path.abspath(args.backgroundimage.name),
-                                                        input_path,
-                                                        worker_nodes=args.workernodes,
-                                                        gpu_batchsize=args.gpubatchsize,
-                                                        model_name=args.model,
-                                                        frame_limit=args.framelimit,
-                                                        framerate=args.framerate)
-                elif args.transparentgif:
-                    utilities.transparentgif(output_path, input_path,
-                                             worker_nodes=args.workernodes,
-                                             gpu_batchsize=args.gpubatchsize,
-                                             model_name=args.model,
-                                             frame_limit=args.framelimit,
-                                             framerate=args.framerate)
-                elif args.transparentgifwithbackground:
-                    utilities.transparentgifwithbackground(output_path, os.path.abspath(args.backgroundimage.name), input_path,
-                                                           worker_nodes=args.workernodes,
-                                                           gpu_batchsize=args.gpubatchsize,
-                                                           model_name=args.model,
-                                                           frame_limit=args.framelimit,
-                                                           framerate=args.framerate)
-            elif is_image_file(f):
-                with open(input_path, "rb") as i, open(output_path, "wb") as o:
-                    r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-                    w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-                    w(
-                        o,
-                        remove(
-                            r(i),
-                            model_name=args.model,
-                            alpha_matting=args.alpha_matting,
-                            alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
-                            alpha_matting_background_threshold=args.alpha_matting_background_threshold,
-                            alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
-                            alpha_matting_base_size=args.alpha_matting_base_size,
-                            only_mask=args.only_mask,
-                            background_color=background_color,
-                            background_image=background_image,
-                        ),
-                    )
-        return
+            os.makedirs(os.path.dirname(output_for(f)), exist_ok=True)
 
-    # Handle stdin/stdout pipe support
-    # When using pipes, we assume image input unless file extension is detected
-    if args.input.name == "<stdin>" or args.output.name == "<stdout>":
-        # Pipe mode - assume image processing
-        r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-        w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-        w(
-            args.output,
-            remove(
-                r(args.input),
+        videos = [os.path.join(input_folder, f) for f in files if is_video_file(f)]
+
+        pipeline = None
+        if len(videos) > 1 and not args.resume and args.segments <= 1 and not args.hosts:
+            # one set of warm workers streams all videos back to back, see utilities.MaskPipeline
+            pipeline = utilities.MaskPipeline(
+                utilities.open_videos(videos, args.framelimit, args.framerate, args.roi, args.start, args.end),
+                worker_nodes=args.workernodes,
+                gpu_batchsize=args.gpubatchsize,
                 model_name=args.model,
+                roi=args.roi,
+                roi_padding=args.roipadding,
+                batch_timeout=args.batchtimeout,
+                max_restarts=args.maxrestarts,
+                threads=args.threads,
+                pin=args.pin,
+                telemetry=telemetry,
+                profiler=profiler)
+
+        def image_done(job):
+            name = os.path.relpath(job[0], input_folder).replace(os.sep, "/")
+            manifest.record(name, job[0], job[1], image_settings)
+
+        try:
+            for f in files:
+                if is_video_file(f):
+                    process_video(os.path.join(input_folder, f), output_for(f), pipeline)
+                    if manifest is not None:
+                        manifest.record(f, os.path.join(input_folder, f), output_for(f), video_settings)
+
+            # the images go through a pipeline of their own: reading, batched inference and writing overlap
+            failed = folder.process_images(
+                [(os.path.join(input_folder, f), output_for(f)) for f in files if is_image_file(f)],
+                model_name=args.model,
+                batch_size=args.imagebatchsize,
+                threads=args.imagethreads,
+                memory_budget=args.memorybudget * 2 ** 20,
+                done=image_done if manifest is not None else None,
+                profiler=profiler,
                 alpha_matting=args.alpha_matting,
                 alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
                 alpha_matting_background_threshold=args.alpha_matting_background_threshold,
@@ -332,80 +767,49 @@ def main():
                 only_mask=args.only_mask,
                 background_color=background_color,
                 background_image=background_image,
-            ),
-        )
+            )
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            if manifest is not None:
+                manifest.save()
+            if telemetry is not None:
+                telemetry.close()
+        if failed:
+            exit(1)
+        return
+
+    if args.inputsequence or args.outputsequence:
+        if args.segments > 1 or args.hosts:
+            print("Segmented processing does not support image sequences")
+            exit(1)
+        if args.outputsequence and "%" not in args.outputsequence:
+            print("--outputsequence needs a pattern with a frame number, like mask_%05d.png")
+            exit(1)
+        if args.inputsequence and not sequence.is_sequence(args.inputsequence):
+            print("--inputsequence needs a directory of frames, a pattern like frame_%05d.png or a glob")
+            exit(1)
+        input_path = args.inputsequence or os.path.abspath(args.input.name)
+        try:
+            process_video(input_path, args.outputsequence or os.path.abspath(args.output.name),
+                          input_sequence=bool(args.inputsequence), output_sequence=bool(args.outputsequence))
+        finally:
+            if telemetry is not None:
+                telemetry.close()
         return
 
     ext = os.path.splitext(args.input.name)[1].lower()
 
-    if ext in [".mp4", ".mov", ".webm", ".ogg", ".gif"]:
-        if args.mattekey:
-            utilities.matte_key(os.path.abspath(args.output.name), os.path.abspath(args.input.name),
-                                worker_nodes=args.workernodes,
-                                gpu_batchsize=args.gpubatchsize,
-                                model_name=args.model,
-                                frame_limit=args.framelimit,
-                                framerate=args.framerate)
-        elif args.transparentvideo:
-            utilities.transparentvideo(os.path.abspath(args.output.name), os.path.abspath(args.input.name),
-                                       worker_nodes=args.workernodes,
-                                       gpu_batchsize=args.gpubatchsize,
-                                       model_name=args.model,
-                                       frame_limit=args.framelimit,
-                                       framerate=args.framerate)
-        elif args.transparentvideoovervideo:
-            utilities.transparentvideoovervideo(os.path.abspath(args.output.name), os.path.abspath(args.backgroundvideo.name),
-                                                os.path.abspath(args.input.name),
-                                                worker_nodes=args.workernodes,
-                                                gpu_batchsize=args.gpubatchsize,
-                                                model_name=args.model,
-                                                frame_limit=args.framelimit,
-                                                framerate=args.framerate)
-        elif args.transparentvideooverimage:
-            utilities.transparentvideooverimage(os.path.abspath(args.output.name), os.path.abspath(args.backgroundimage.name),
-                                                os.path.abspath(args.input.name),
-                                                worker_nodes=args.workernodes,
-                                                gpu_batchsize=args.gpubatchsize,
-                                                model_name=args.model,
-                                                frame_limit=args.framelimit,
-                                                framerate=args.framerate)
-        elif args.transparentgif:
-            utilities.transparentgif(os.path.abspath(args.output.name), os.path.abspath(args.input.name),
-                                     worker_nodes=args.workernodes,
-                                     gpu_batchsize=args.gpubatchsize,
-                                     model_name=args.model,
-                                     frame_limit=args.framelimit,
-                                     framerate=args.framerate)
-        elif args.transparentgifwithbackground:
-            utilities.transparentgifwithbackground(os.path.abspath(args.output.name), os.path.abspath(args.backgroundimage.name), os.path.abspath(args.input.name),
-                                                   worker_nodes=args.workernodes,
-                                                   gpu_batchsize=args.gpubatchsize,
-                                                   model_name=args.model,
-                                                   frame_limit=args.framelimit,
-                                                   framerate=args.framerate)
-
-    elif ext in [".jpg", ".jpeg", ".png", ".heic", ".heif"]:
-        r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-        w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-        w(
-            args.output,
-            remove(
-                r(args.input),
-                model_name=args.model,
-                alpha_matting=args.alpha_matting,
-                alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
-                alpha_matting_background_threshold=args.alpha_matting_background_threshold,
-                alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
-                alpha_matting_base_size=args.alpha_matting_base_size,
-                only_mask=args.only_mask,
-                background_color=background_color,
-                background_image=background_image,
-            ),
-        )
+    if ext in [".mp4", ".mov", ".mkv", ".webm", ".ogg", ".gif"]:
+        try:
+            process_video(os.path.abspath(args.input.name), os.path.abspath(args.output.name))
+        finally:
+            if telemetry is not None:
+                telemetry.close()
     else:
         print(f"❌ Unsupported file type: {ext}")
         print(f"Supported image formats: .jpg, .jpeg, .png, .heic, .heif")
-        print(f"Supported video formats: .mp4, .mov, .webm, .ogg, .gif")
+        print(f"Supported video formats: .mp4, .mov, .mkv, .webm, .ogg, .gif")
         exit(1)
 
 
@@ -8,9 +8,12 @@ from urllib.request import urlopen
 from flask import Flask, request, send_file
 from waitress import serve
 
+from ..autotune import load_profile
 from ..bg import remove
+from ..cpu import set_thread_budget
 
 app = Flask(__name__)
+app.config["DEFAULT_MODEL"] = "u2net"
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -39,7 +42,7 @@ def index():
     ae = request.values.get("ae", type=int, default=10)
     az = request.values.get("az", type=int, default=1000)
 
-    model = request.args.get("model", type=str, default="u2net")
+    model = request.args.get("model", type=str, default=app.config["DEFAULT_MODEL"])
     model_path = os.environ.get(
         "U2NETP_PATH",
         os.path.expanduser(os.path.join("~", ".u2net")),
@@ -90,8 +93,38 @@ def main():
         help="The port to bind to.",
     )
 
+    ap.add_argument(
+        "-t",
+        "--threads",
+        default=4,
+        type=int,
+        help="Number of requests handled at the same time.",
+    )
+
+    ap.add_argument(
+        "-m",
+        "--model",
+        default="u2net",
+        choices=["u2net", "u2netp", "u2net_human_seg"],
+        help="Model of the requests that don't choose one, its autotune profile sets the CPU threads.",
+    )
+
+    ap.add_argument(
+        "-th",
+        "--torchthreads",
+        default=None,
+        type=int,
+        help="CPU threads used by the model, defaults to the value found by backgroundremover autotune "
+             "or the cores divided by --threads.",
+    )
+
     args = ap.parse_args()
-    serve(app, host=args.addr, port=args.port)
+    app.config["DEFAULT_MODEL"] = args.model
+    # concurrent requests share the cores instead of each trying to use all of them
+    if args.torchthreads is None:
+        args.torchthreads = load_profile(args.model).get("threads", 0)
+    set_thread_budget(worker_nodes=args.threads, threads=args.torchthreads)
+    serve(app, host=args.addr, port=args.port, threads=args.threads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import glob
+import os
+import torch
+
+
+def available_cores():
+    """The CPU cores this process is allowed to run on."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def parse_cpulist(text):
+    cores = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def numa_nodes():
+    """Cores of every NUMA node, a single node holding all cores when the
+    topology is not exposed (non Linux, containers without /sys)."""
+    allowed = set(available_cores())
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cores = [core for core in parse_cpulist(f.read()) if core in allowed]
+        if cores:
+            nodes.append(cores)
+    return nodes or [available_cores()]
+
+
+def worker_cores(worker_index, worker_nodes, pin=None):
+    """Cores for one of ``worker_nodes`` processes.
+
+    ``pin="cores"`` hands every worker a disjoint, contiguous share of the
+    cores, ``pin="numa"`` spreads the workers over the NUMA nodes so each
+    one stays on the memory of its node. Without pinning every worker may
+    run anywhere.
+    """
+    cores = available_cores()
+    if pin == "numa":
+        nodes = numa_nodes()
+        node = nodes[worker_index % len(nodes)]
+        # workers sharing a node split it between them
+        sharing = [i for i in range(worker_nodes) if i % len(nodes) == worker_index % len(nodes)]
+        return split(node, len(sharing))[sharing.index(worker_index)]
+    if pin == "cores":
+        return split(cores, worker_nodes)[worker_index]
+    return cores
+
+
+def split(cores, parts):
+    size, extra = divmod(len(cores), parts)
+    if size == 0:
+        # more workers than cores, they have to share
+        return [[cores[i % len(cores)]] for i in range(parts)]
+    shares, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        shares.append(cores[start:end])
+        start = end
+    return shares
+
+
+def set_thread_budget(worker_index=0, worker_nodes=1, threads=0, pin=None):
+    """Limit torch in this process to its share of the machine.
+
+    Each of ``worker_nodes`` processes gets ``threads`` intra-op threads, by
+    default its share of the cores, so parallel workers don't oversubscribe
+    the CPU. Inter-op parallelism is turned off since the models run their
+    layers one after the other. With ``pin`` the process is also bound to its
+    cores, see worker_cores().
+    """
+    cores = worker_cores(worker_index, worker_nodes, pin)
+    if pin in ("cores", "numa") and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+        budget = len(cores)
+    else:
+        budget = max(1, len(cores) // worker_nodes)
+
+    torch.set_num_threads(threads or budget)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel work in the process
+        pass
+    return threads or budget
@@ -0,0 +1,220 @@
+"""A background process that keeps the models loaded and answers requests
+on a Unix socket, so a short job doesn't pay for starting torch and loading
+a model. remove() uses it when it is running.
+
+This module is imported by the CLI and the GUIs before anything else, so
+it must not import torch; the serving side is imported in serve().
+"""
+import argparse
+import base64
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from .protocol import read_message, write_message
+
+SOCKET_PATH = os.environ.get(
+    "BACKGROUNDREMOVER_SOCKET",
+    os.path.expanduser(os.path.join("~", ".u2net", "daemon.sock")),
+)
+
+
+def request(header, payload=b"", path=SOCKET_PATH):
+    """Send a request to the daemon and return its (header, payload), or
+    None when no daemon is listening on ``path``."""
+    if not hasattr(socket, "AF_UNIX") or not path or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # a socket file left behind by a daemon that died
+        sock.close()
+        return None
+    with sock, sock.makefile("rb") as reader, sock.makefile("wb") as writer:
+        write_message(writer, header, payload)
+        writer.flush()
+        return read_message(reader)
+
+
+def running(path=SOCKET_PATH):
+    """True when a daemon answers on ``path``."""
+    return request({"command": "status"}, path=path) is not None
+
+
+def remove(
+    data,
+    model_name="u2net",
+    alpha_matting=False,
+    alpha_matting_foreground_threshold=240,
+    alpha_matting_background_threshold=10,
+    alpha_matting_erode_structure_size=10,
+    alpha_matting_base_size=1000,
+    only_mask=False,
+    background_color=None,
+    background_image=None,
+    profiler=None,
+):
+    """bg.remove() on the running daemon, or in this process when there is
+    none. With a Profiler it always runs in this process."""
+    options = dict(
+        alpha_matting=alpha_matting,
+        alpha_matting_foreground_threshold=alpha_matting_foreground_threshold,
+        alpha_matting_background_threshold=alpha_matting_background_threshold,
+        alpha_matting_erode_structure_size=alpha_matting_erode_structure_size,
+        alpha_matting_base_size=alpha_matting_base_size,
+        only_mask=only_mask,
+        background_color=background_color,
+        background_image=background_image,
+    )
+    # arrays can't be sent, only image files
+    if profiler is None and isinstance(data, (bytes, bytearray, memoryview)) and \
+            (background_image is None or isinstance(background_image, (bytes, bytearray, memoryview))):
+        header = dict(options, model=model_name,
+                      background_color=list(background_color) if background_color is not None else None)
+        if background_image is not None:
+            header["background_image"] = base64.b64encode(background_image).decode()
+        else:
+            del header["background_image"]
+        response = request(header, bytes(data))
+        if response is not None:
+            header, payload = response
+            if "error" in header:
+                raise ValueError(header["error"])
+            return payload
+
+    from .bg import remove as remove_here
+    return remove_here(data, model_name=model_name, profiler=profiler, **options)
+
+
+if hasattr(socket, "AF_UNIX"):
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    # no Unix sockets, e.g. on older Windows; remove() runs in the process
+    Server = None
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.answer()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, e.g. once it read the header it needed
+            pass
+
+    def answer(self):
+        while True:
+            message = read_message(self.rfile)
+            if message is None:
+                break
+            header, _ = message
+            if header.get("command") == "status":
+                write_message(self.wfile, {"pid": os.getpid(), "models": self.server.models})
+            elif header.get("command") == "stop":
+                write_message(self.wfile, {"pid": os.getpid()})
+                self.server.requests.put(None)
+            else:
+                # answered by the batching loop in serve(), together with
+                # the requests of other clients that wait at the same time
+                result = Future()
+                self.server.requests.put((message, result))
+                write_message(self.wfile, *result.result())
+            self.wfile.flush()
+
+
+def serve(path=SOCKET_PATH, models=("u2net",), batch_size=4, threads=0):
+    """Load ``models`` and answer requests on the socket ``path`` until
+    stopped. Requests of clients that wait at the same time are batched, up
+    to ``batch_size``, see stream.handle()."""
+    if Server is None:
+        raise Exception("The daemon needs Unix sockets, which this platform doesn't have")
+    from .bg import get_model
+    from .stream import handle
+
+    if request({"command": "status"}, path=path) is not None:
+        raise Exception(F"A daemon is already listening on {path}")
+    if os.path.exists(path):
+        os.unlink(path)
+    for model_name in models:
+        get_model(model_name)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # only the user that started the daemon may use it, from the moment the socket exists
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    server.models = list(models)
+    server.requests = queue.Queue()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: server.requests.put(None))
+    print(F"DAEMON LISTENING ON {path} (PID {os.getpid()})")
+
+    try:
+        with ThreadPoolExecutor(threads or min(8, os.cpu_count() or 1)) as pool:
+            while True:
+                batch = [server.requests.get()]
+                while len(batch) < batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(server.requests.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                batch = [item for item in batch if item is not None]
+                if batch:
+                    try:
+                        answers = handle([message for message, _ in batch], pool, {})
+                    except Exception as e:
+                        answers = [({"error": str(e)}, b"")] * len(batch)
+                    for (_, result), answer in zip(batch, answers):
+                        result.set_result(answer)
+                if stop:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    print("DAEMON STOPPED")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="backgroundremover daemon",
+                                 description="Keep models loaded and serve requests on a Unix socket. While it runs, "
+                                             "backgroundremover and the GUIs send their images to it instead of "
+                                             "loading a model themselves.")
+    ap.add_argument("-s", "--socket", default=SOCKET_PATH,
+                    help="Path of the socket, also set with BACKGROUNDREMOVER_SOCKET.")
+    ap.add_argument("-m", "--models", default="u2net",
+                    help="Comma separated models to load at start, others are loaded on their first request.")
+    ap.add_argument("-b", "--batchsize", default=4, type=int,
+                    help="Most requests of different clients to run through the model at once.")
+    ap.add_argument("-th", "--threads", default=0, type=int,
+                    help="Threads that decode and encode images, 0 for one per core up to 8.")
+    ap.add_argument("--status", action="store_true",
+                    help="Show whether a daemon is running.")
+    ap.add_argument("--stop", action="store_true",
+                    help="Stop the running daemon.")
+    args = ap.parse_args(argv)
+
+    if args.status or args.stop:
+        response = request({"command": "stop" if args.stop else "status"}, path=args.socket)
+        if response is None:
+            print(F"No daemon is listening on {args.socket}")
+            sys.exit(1)
+        header, _ = response
+        if args.stop:
+            print(F"Stopped the daemon (PID {header['pid']})")
+        else:
+            print(F"Daemon running (PID {header['pid']}), models loaded at start: {', '.join(header['models'])}")
+        return
+
+    serve(args.socket, args.models.split(","), args.batchsize, args.threads)
@@ -0,0 +1,263 @@
+import fnmatch
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .bg import cutout_image, get_model, load_image
+from .profiler import stage
+from .u2net import detect
+
+MANIFEST = ".backgroundremover.json"
+# the manifest of shard i of N, see shard_of()
+SHARD_MANIFEST = ".backgroundremover.shard-%d-of-%d.json"
+
+
+class MemoryBudget:
+    """Bytes the stages of process_images() may hold at once. An image
+    larger than the whole budget is still let through, on its own."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        with self.cond:
+            self.cond.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+
+def matches(path, patterns):
+    """True if ``path`` (relative, with forward slashes) matches one of the
+    globs. A glob without a slash is matched against the file name alone."""
+    name = path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(path if "/" in pattern else name, pattern) for pattern in patterns)
+
+
+def find_files(folder, accept, recursive=False, include=None, exclude=None, skip_dirs=()):
+    """Paths relative to ``folder`` of the files that ``accept`` takes, in
+    sorted order. With ``recursive`` subfolders are searched too, except
+    ``skip_dirs``. ``include`` and ``exclude`` are lists of globs, see matches().
+    """
+    skip_dirs = {os.path.abspath(d) for d in skip_dirs}
+    found = []
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip_dirs) \
+            if recursive else []
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), folder).replace(os.sep, "/")
+            if not accept(name) or (include and not matches(path, include)) or (exclude and matches(path, exclude)):
+                continue
+            found.append(path)
+    return sorted(found)
+
+
+def shard_of(name, count):
+    """The shard of ``count`` that owns the file ``name``, relative to the
+    input folder. The name is hashed, so every machine comes to the same
+    split without coordination and the shards are about the same size."""
+    return int(hashlib.sha256(name.encode()).hexdigest()[:16], 16) % count
+
+
+def manifest_path(folder, shard=None):
+    """The manifest of ``folder``, or of the (index, count) ``shard`` of it:
+    every shard keeps its own, so they never write the same file."""
+    if shard is None:
+        return os.path.join(folder, MANIFEST)
+    return os.path.join(folder, SHARD_MANIFEST % shard)
+
+
+def shard_counts(folder):
+    """The shard counts of the shard manifests in ``folder``."""
+    pattern = re.compile("^" + re.escape(SHARD_MANIFEST).replace("%d", r"(\d+)") + "$")
+    matches = (pattern.match(name) for name in os.listdir(folder)) if os.path.isdir(folder) else ()
+    return sorted({int(match.group(2)) for match in matches if match})
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """The inputs of a folder that were processed, so that a rerun only
+    processes new and changed ones.
+
+    Every entry holds the size, modification time and SHA-256 of an input,
+    the settings it was processed with and its output. An input is up to
+    date when its output still exists and neither the settings nor the file
+    changed; the file is only hashed again when its size or time changed.
+    The manifest is written every few seconds and by save().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = time.time()
+        try:
+            with open(path) as f:
+                self.files = json.load(f)["files"]
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+
+    @property
+    def outputs(self):
+        return {entry["output"] for entry in self.files.values()}
+
+    def up_to_date(self, name, input_path, output_path, settings):
+        entry = self.files.get(name)
+        if entry is None or entry["settings"] != settings or entry["output"] != output_path \
+                or not os.path.exists(output_path):
+            return False
+        stat = os.stat(input_path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["size"] != stat.st_size or entry["sha256"] != file_hash(input_path):
+            return False
+        # touched but not changed
+        with self.lock:
+            entry["mtime"] = stat.st_mtime
+        return True
+
+    def record(self, name, input_path, output_path, settings):
+        stat = os.stat(input_path)
+        entry = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_hash(input_path),
+            "settings": settings,
+            "output": output_path,
+        }
+        with self.lock:
+            self.files[name] = entry
+        if time.time() - self.saved > 5:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"files": self.files}, f, indent=1)
+            os.replace(self.path + ".tmp", self.path)
+            self.saved = time.time()
+
+
+def process_images(jobs, model_name="u2net", batch_size=4, threads=0, memory_budget=1024 * 2 ** 20, done=None,
+                   profiler=None, error=None, **options):
+    """Remove the background of many images, ``jobs`` being (input path,
+    output path) pairs. ``options`` are those of remove().
+
+    The files are read and decoded on a pool of ``threads`` threads, the
+    model runs on batches of up to ``batch_size`` decoded images and the
+    cutouts are composited and encoded on a second pool, so the three stages
+    overlap and the model is loaded once. The images between reading and
+    writing hold at most ``memory_budget`` bytes. ``done`` is called with
+    every job whose output was written. A file that fails is reported and
+    skipped, and ``error`` called with its job and the exception; returns
+    the paths of those files. A Profiler records the time and memory of
+    every stage.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    threads = threads or min(8, os.cpu_count() or 1)
+    with stage(profiler, "load model"):
+        model = get_model(model_name)
+    if isinstance(options.get("background_image"), (bytes, bytearray, memoryview)):
+        # decode the background once instead of for every image
+        options["background_image"] = np.asarray(load_image(options["background_image"]))
+
+    budget = MemoryBudget(memory_budget)
+    decoded = queue.Queue(maxsize=batch_size * 2)
+    failed = []
+
+    def fail(job, e):
+        print(F"Failed to process {job[0]}: {e}")
+        failed.append(job[0])
+        if error is not None:
+            error(job, e)
+
+    def read(path):
+        with stage(profiler, "read"), open(path, "rb") as f:
+            data = f.read()
+        return load_image(data, profiler)
+
+    def feed():
+        with ThreadPoolExecutor(threads) as readers:
+            pending = deque()
+
+            def hand_on():
+                job, future = pending.popleft()
+                try:
+                    image = future.result()
+                except Exception as e:
+                    fail(job, e)
+                    return
+                # the decoded image, its mask and the cutout, about 8 bytes a pixel
+                size = image.width * image.height * 8
+                budget.acquire(size)
+                decoded.put((job, image, size))
+
+            for job in jobs:
+                pending.append((job, readers.submit(read, job[0])))
+                if len(pending) >= threads * 2:
+                    hand_on()
+            while pending:
+                hand_on()
+        decoded.put(None)
+
+    def write(job, image, mask, size):
+        try:
+            data = cutout_image(image, mask, profiler=profiler, **options)
+            with stage(profiler, "write"), open(job[1], "wb") as f:
+                f.write(data)
+            if done is not None:
+                done(job)
+        except Exception as e:
+            fail(job, e)
+        finally:
+            budget.release(size)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    with ThreadPoolExecutor(threads) as writers:
+        finished = False
+        while not finished:
+            # a batch of the images that are decoded already, the model doesn't wait for more
+            batch = [decoded.get()]
+            while len(batch) < batch_size and batch[-1] is not None:
+                try:
+                    batch.append(decoded.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                finished = True
+            if not batch:
+                continue
+
+            try:
+                masks = detect.predict_many(model, [np.array(image) for _, image, _ in batch], profiler)
+            except Exception as e:
+                for job, _, size in batch:
+                    fail(job, e)
+                    budget.release(size)
+                continue
+            for (job, image, size), mask in zip(batch, masks):
+                writers.submit(write, job, image, mask.convert("L"), size)
+    feeder.join()
+    print(F"PROCESSED {len(jobs) - len(failed)} IMAGES")
+    return failed
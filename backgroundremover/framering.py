@@ -0,0 +1,99 @@
+from multiprocessing import shared_memory
+import numpy as np
+import torch.multiprocessing as multiprocessing
+
+
+class FrameRing:
+    """A fixed number of frame slots in shared memory.
+
+    Frame ``index`` is stored in slot ``index % slots``. Producers wait until
+    the previous frame of that slot has been released and consumers wait for
+    the exact frame index they need, so frames can be produced and consumed
+    out of order by several processes while the pixel data never goes through
+    a pipe or a pickle. Waiting is done on a condition variable, not polling.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._owner = True
+        self._array = None
+        self._cond = multiprocessing.Condition()
+        # index of the frame currently stored in each slot
+        self._ready = multiprocessing.RawArray('q', [-1] * slots)
+        # index of the last frame released from each slot
+        self._released = multiprocessing.RawArray('q', [slot - slots for slot in range(slots)])
+        # number of frames in the stream once it is known, -1 before that
+        self._end = multiprocessing.RawValue('q', -1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        state['_owner'] = False
+        return state
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        return self._array
+
+    def _wait(self, predicate, timeout):
+        if not self._cond.wait_for(predicate, timeout):
+            raise TimeoutError("timed out waiting for the frame buffer")
+
+    def reserve(self, index, timeout=None):
+        """Wait until the slot of frame ``index`` is free and return it for writing."""
+        slot = index % self.slots
+        with self._cond:
+            self._wait(lambda: self._released[slot] >= index - self.slots, timeout)
+        return self.array[slot]
+
+    def commit(self, index):
+        """Mark frame ``index`` as written and wake up its consumer."""
+        with self._cond:
+            self._ready[index % self.slots] = index
+            self._cond.notify_all()
+
+    def put(self, index, frame, timeout=None):
+        np.copyto(self.reserve(index, timeout), frame)
+        self.commit(index)
+
+    def get(self, index, timeout=None):
+        """Wait for frame ``index`` and return a view of it.
+
+        Returns None when the stream ended before ``index``. The view stays
+        valid until the frame is released.
+        """
+        slot = index % self.slots
+        with self._cond:
+            self._wait(lambda: self._ready[slot] == index or 0 <= self._end.value <= index, timeout)
+            if self._ready[slot] != index:
+                return None
+        return self.array[slot]
+
+    def release(self, index):
+        """Give the slot of frame ``index`` back to the producers."""
+        slot = index % self.slots
+        with self._cond:
+            self._released[slot] = index
+            self._cond.notify_all()
+
+    def close(self, count):
+        """Mark the end of the stream after ``count`` frames."""
+        with self._cond:
+            self._end.value = count
+            self._cond.notify_all()
+
+    @property
+    def end(self):
+        return self._end.value
+
+    def unlink(self):
+        self._array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,201 @@
+"""Wall time and peak memory of the stages of a job, see --profile."""
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, where the peak memory is left out
+    resource = None
+
+
+def peak_rss():
+    """The peak resident memory of this process in bytes, 0 where unknown."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def stage(profiler, name):
+    """profiler.stage(name), or nothing without a profiler."""
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+class Profiler:
+    """Records the wall time of every run of the stages of a job and the
+    peak resident memory of the process after it.
+
+    The peak only ever grows, so the stage during which it grows is the one
+    that needs the memory; the summary shows both. Stages can run on many
+    threads at once. A copy of the profiler handed to a child process sends
+    its records back once share() was called before starting the child.
+    """
+
+    def __init__(self, process="main"):
+        self.process = process
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+        self.queue = None
+        self.receiver = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["events"] = []
+        state["receiver"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def share(self):
+        if self.queue is not None:
+            return
+        self.queue = multiprocessing.Queue()
+        # read all the time, a child with records stuck in the pipe can't exit
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def receive(self):
+        for events in iter(self.queue.get, None):
+            with self.lock:
+                self.events.extend(events)
+
+    @contextmanager
+    def stage(self, name):
+        before = peak_rss()
+        start, clock = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - clock
+            after = peak_rss()
+            self.record({
+                "stage": name,
+                "process": self.process,
+                "pid": os.getpid(),
+                "thread": threading.get_native_id(),
+                "start": start,
+                "seconds": seconds,
+                "peak_rss": after,
+                "peak_rss_growth": after - before,
+            })
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+            if self.queue is not None and os.getpid() != self.pid and len(self.events) >= 256:
+                self.flush_locked()
+
+    def flush(self):
+        """Send the records of a child process to the parent, before the child ends."""
+        with self.lock:
+            if self.queue is not None and os.getpid() != self.pid and self.events:
+                self.flush_locked()
+
+    def flush_locked(self):
+        # the queue pickles the list later, on a thread of its own
+        self.queue.put(self.events)
+        self.events = []
+
+    def collect(self):
+        """All records, those of finished child processes included."""
+        if self.receiver is not None:
+            # after the records of the children that ended already
+            self.queue.put(None)
+            self.receiver.join()
+            self.receiver = None
+        with self.lock:
+            return sorted(self.events, key=lambda event: event["start"])
+
+    def summary(self, events=None):
+        """Every stage in the order it first ran, with its number of runs,
+        total, mean and longest seconds, the highest peak memory after it
+        and how much it grew the peak memory in total."""
+        stages = {}
+        for event in self.collect() if events is None else events:
+            entry = stages.setdefault(event["stage"], {
+                "stage": event["stage"],
+                "calls": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "peak_rss": 0,
+                "peak_rss_growth": 0,
+            })
+            entry["calls"] += 1
+            entry["seconds"] += event["seconds"]
+            entry["max_seconds"] = max(entry["max_seconds"], event["seconds"])
+            entry["peak_rss"] = max(entry["peak_rss"], event["peak_rss"])
+            entry["peak_rss_growth"] += event["peak_rss_growth"]
+        for entry in stages.values():
+            entry["mean_seconds"] = entry["seconds"] / entry["calls"]
+        return list(stages.values())
+
+    def processes(self, events):
+        peaks = {}
+        for event in events:
+            peaks[event["process"]] = max(peaks.get(event["process"], 0), event["peak_rss"])
+        return peaks
+
+    def print_summary(self, events, stream=sys.stderr):
+        stages = self.summary(events)
+        # stages of a pipeline run side by side, so the shares are of the
+        # time spent in all stages rather than of the wall time
+        total = sum(entry["seconds"] for entry in stages) or 1e-9
+        mb = 2 ** 20
+        print(F"{'STAGE':<16}{'CALLS':>8}{'TOTAL S':>10}{'MEAN MS':>10}{'MAX MS':>10}{'SHARE':>8}"
+              F"{'PEAK RSS MB':>13}{'GROWTH MB':>11}", file=stream)
+        for entry in stages:
+            print(F"{entry['stage']:<16}{entry['calls']:>8}{entry['seconds']:>10.3f}"
+                  F"{entry['mean_seconds'] * 1000:>10.2f}{entry['max_seconds'] * 1000:>10.2f}"
+                  F"{entry['seconds'] / total:>8.1%}{entry['peak_rss'] / mb:>13.1f}"
+                  F"{entry['peak_rss_growth'] / mb:>11.1f}", file=stream)
+        peaks = ", ".join(F"{process} {peak / mb:.1f} MB" for process, peak in self.processes(events).items())
+        print(F"WALL TIME {time.time() - self.started:.3f} S, PEAK RSS {peaks or 'unknown'}", file=stream)
+
+    def write_json(self, path, events):
+        with open(path, "w") as f:
+            json.dump({
+                "wall_seconds": time.time() - self.started,
+                "stages": self.summary(events),
+                "peak_rss": self.processes(events),
+                "events": [dict(event, start=event["start"] - self.started) for event in events],
+            }, f, indent=1)
+
+    def write_trace(self, path, events):
+        """Write the runs of the stages in the Chrome trace format, for
+        chrome://tracing or https://ui.perfetto.dev."""
+        trace = []
+        for pid, process in sorted({(event["pid"], event["process"]) for event in events}):
+            trace.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": process}})
+        for event in events:
+            trace.append({
+                "name": event["stage"],
+                "ph": "X",
+                "ts": (event["start"] - self.started) * 1e6,
+                "dur": event["seconds"] * 1e6,
+                "pid": event["pid"],
+                "tid": event["thread"],
+                "args": {"peak_rss_mb": round(event["peak_rss"] / 2 ** 20, 1)},
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def report(self, json_path=None, trace_path=None):
+        """Print the summary to stderr and write the records as JSON and/or a Chrome trace."""
+        events = self.collect()
+        self.print_summary(events)
+        if json_path:
+            self.write_json(json_path, events)
+        if trace_path:
+            self.write_trace(trace_path, events)
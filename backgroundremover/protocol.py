@@ -0,0 +1,96 @@
+"""Framed image requests and results for long running processes, see
+stream.py and daemon.py.
+
+Every message is a JSON header plus an optional payload of bytes. With the
+``length`` framing a message is a 4 byte big endian length and the header,
+then a 4 byte length and the payload. With ``ndjson`` it is one line of JSON
+and the payload is base64 in its ``"image"`` field.
+
+A request carries the image as payload, or names it with ``"path"``. Its
+header may hold an ``"id"``, an ``"output"`` path to write the result to
+instead of returning it, and any of OPTIONS to override the defaults of the
+process (``"background_image"`` as base64 of an image file). The result header echoes the ``"id"`` and holds either
+``"output"`` or ``"error"``; the payload is the PNG, empty when it was
+written to a file or failed.
+"""
+import base64
+import json
+import struct
+
+OPTIONS = (
+    "model",
+    "alpha_matting",
+    "alpha_matting_foreground_threshold",
+    "alpha_matting_background_threshold",
+    "alpha_matting_erode_structure_size",
+    "alpha_matting_base_size",
+    "only_mask",
+    "background_color",
+    "background_image",
+)
+
+
+class MalformedMessage(Exception):
+    """A message whose header or payload can't be decoded. It was read to
+    its end, so the next message can still be read."""
+
+
+def read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            if data:
+                raise Exception("The stream ended in the middle of a message")
+            return None
+        data += chunk
+    return data
+
+
+def read_message(stream, framing="length"):
+    """The next (header, payload) of ``stream``, None at its end. Raises
+    MalformedMessage for a message that can't be decoded."""
+    if framing == "ndjson":
+        line = b""
+        while not line.strip():
+            line = stream.readline()
+            if not line:
+                return None
+        try:
+            header = json.loads(line)
+            if not isinstance(header, dict):
+                raise ValueError("the header is not a JSON object")
+            return header, base64.b64decode(header.pop("image", ""))
+        except ValueError as e:
+            raise MalformedMessage(str(e))
+
+    prefix = read_exactly(stream, 4)
+    if prefix is None:
+        return None
+    data = read_exactly(stream, struct.unpack(">I", prefix)[0])
+    size = read_exactly(stream, 4)
+    if size is None:
+        raise Exception("The stream ended in the middle of a message")
+    payload = read_exactly(stream, struct.unpack(">I", size)[0]) or b""
+    try:
+        header = json.loads(data or b"{}")
+    except ValueError as e:
+        raise MalformedMessage(str(e))
+    if not isinstance(header, dict):
+        raise MalformedMessage("the header is not a JSON object")
+    return header, payload
+
+
+def write_message(stream, header, payload=b"", framing="length"):
+    if framing == "ndjson":
+        if payload:
+            header = dict(header, image=base64.b64encode(payload).decode())
+        stream.write(json.dumps(header).encode() + b"\n")
+        return
+    data = json.dumps(header).encode()
+    stream.write(struct.pack(">I", len(data)) + data + struct.pack(">I", len(payload)))
+    # an empty write on a socket whose client read the header and left fails
+    if payload:
+        stream.write(payload)
+
+
@@ -0,0 +1,98 @@
+import os
+import queue
+import shlex
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .video import probe_video
+
+LOCAL_COMMAND = [sys.executable, "-m", "backgroundremover.cmd.cli"]
+REMOTE_COMMAND = "backgroundremover"
+
+
+def split_video(file_path, segment_dir, segments):
+    """Cut the video stream of ``file_path`` into about ``segments`` pieces
+    without re-encoding. Cuts land on the next keyframe after each split point,
+    so every piece decodes on its own."""
+    info = probe_video(file_path)
+    if not info["duration"]:
+        raise Exception("Could not detect the duration of the video, can't split it into segments")
+
+    pattern = os.path.join(segment_dir, "segment_%04d.mkv")
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path,
+           '-map', '0:v:0', '-c', 'copy',
+           '-f', 'segment', '-segment_time', F"{info['duration'] / segments:.3f}",
+           '-reset_timestamps', '1', pattern]
+    sp.run(cmd, check=True)
+    return sorted(os.path.join(segment_dir, f) for f in os.listdir(segment_dir) if f.startswith("segment_"))
+
+
+def concat_videos(paths, output, list_dir):
+    """Join ``paths`` into ``output`` with the concat demuxer, without re-encoding."""
+    list_file = os.path.join(list_dir, "concat.txt")
+    with open(list_file, "w") as f:
+        for path in paths:
+            f.write("file '%s'\n" % path.replace("'", "'\\''"))
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', output]
+    sp.run(cmd, check=True)
+
+
+def segment_command(segment, output, cli_args, host=None, remote_command=REMOTE_COMMAND):
+    args = ["-i", segment, "-o", output] + cli_args
+    if host is None:
+        return LOCAL_COMMAND + args
+    return ["ssh", host, " ".join([remote_command] + [shlex.quote(a) for a in args])]
+
+
+def process_segmented(output, file_path, cli_args, segments,
+                      hosts=None,
+                      shared_dir=None,
+                      remote_command=REMOTE_COMMAND):
+    """Process ``file_path`` as independent keyframe aligned segments.
+
+    ``cli_args`` are the command line arguments every segment is processed
+    with (mode, model, workers...). Segments run as separate local processes,
+    or round-robin over ``hosts`` through ssh, in which case ``shared_dir``
+    must be a directory that every host sees under the same path. The outputs
+    are concatenated into ``output`` without re-encoding.
+    """
+    if hosts and not shared_dir:
+        raise Exception("Processing segments on other hosts needs a shared directory")
+
+    work_dir = tempfile.mkdtemp(prefix="backgroundremover-", dir=shared_dir)
+    try:
+        segment_dir = os.path.join(work_dir, "input")
+        os.makedirs(segment_dir)
+        pieces = split_video(os.path.abspath(file_path), segment_dir, segments)
+        print(F"SPLIT INTO {len(pieces)} SEGMENTS")
+
+        ext = os.path.splitext(output)[1] or ".mov"
+        outputs = [os.path.join(work_dir, "output_%04d%s" % (i, ext)) for i in range(len(pieces))]
+
+        # one slot per parallel job, a host listed twice runs two segments at once
+        slots = queue.Queue()
+        for slot in (hosts or [None] * segments):
+            slots.put(slot)
+
+        def run(i):
+            host = slots.get()
+            try:
+                print(F"SEGMENT {i} STARTED ON {host or 'localhost'}")
+                result = sp.run(segment_command(pieces[i], outputs[i], cli_args, host, remote_command),
+                            stdin=sp.DEVNULL)
+                if result.returncode != 0:
+                    raise Exception(F"Segment {i} ({pieces[i]}) failed on {host or 'localhost'}")
+                print(F"SEGMENT {i} FINISHED")
+            finally:
+                slots.put(host)
+
+        with ThreadPoolExecutor(max_workers=slots.qsize()) as pool:
+            for future in [pool.submit(run, i) for i in range(len(pieces))]:
+                future.result()
+
+        concat_videos(outputs, os.path.abspath(output), work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(F"FINISHED ALL SEGMENTS ({len(pieces)})!")
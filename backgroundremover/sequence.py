@@ -0,0 +1,186 @@
+import glob
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import numpy as np
+from PIL import Image
+from .profiler import stage
+from .video import scaled_size
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff", ".jpg", ".jpeg", ".bmp")
+
+
+def is_sequence(path):
+    """True for a directory of frames, a printf pattern (``frame_%05d.png``)
+    or a glob (``frames/*.tif``). An existing file is never a sequence, even
+    with ``[`` or ``%`` in its name."""
+    if os.path.isfile(path):
+        return False
+    return os.path.isdir(path) or "%" in path or glob.has_magic(path)
+
+
+def sequence_files(path):
+    """The frame files of a sequence in frame order.
+
+    Files of a directory or a glob are ordered by name, so the frame numbers
+    in the names need leading zeros. A printf pattern is ordered by number.
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if len({os.path.splitext(f)[1].lower() for f in files}) > 1:
+            raise Exception(F"{path} holds frames of different formats, select them with a pattern like {path}/*.png")
+    elif "%" in path:
+        directory, name = os.path.split(path)
+        regex = re.compile("^" + re.sub(r"%0?(\d*)d",
+                                        lambda m: r"(\d{%s})" % m.group(1) if m.group(1) else r"(\d+)",
+                                        re.escape(name).replace(r"\%", "%")) + "$")
+        numbered = []
+        for f in os.listdir(directory or "."):
+            match = regex.match(f)
+            if match:
+                numbered.append((int(match.group(1)), os.path.join(directory, f)))
+        files = [f for _, f in sorted(numbered)]
+    else:
+        files = sorted(glob.glob(path))
+    if not files:
+        raise Exception(F"No frames found for {path}")
+    return files
+
+
+def probe_sequence(path, framerate="25"):
+    """Like probe_video() for an image sequence, which has no frame rate of
+    its own. The size is taken from the first frame."""
+    files = sequence_files(path)
+    with Image.open(files[0]) as image:
+        width, height = image.size
+    fps = float(Fraction(framerate))
+    return {
+        "width": width,
+        "height": height,
+        "framerate": str(framerate),
+        "fps": fps,
+        "frames": len(files),
+        "duration": len(files) / fps,
+        "files": files,
+        "pattern": path,
+    }
+
+
+def sequence_input(info):
+    """ffmpeg input options that read the frames of a sequence, in the same order."""
+    path = info["pattern"]
+    if "%" in path:
+        number = re.search(r"(\d+)\D*$", os.path.basename(info["files"][0])).group(1)
+        return ['-framerate', info["framerate"], '-start_number', str(int(number)), '-i', path]
+    if os.path.isdir(path):
+        path = os.path.join(path, "*" + os.path.splitext(info["files"][0])[1])
+    return ['-framerate', info["framerate"], '-pattern_type', 'glob', '-i', path]
+
+
+def load_frame(path, size, pix_fmt="rgb24"):
+    image = Image.open(path)
+    frame = np.asarray(image)
+    if frame.dtype.kind in "ui" and frame.dtype != np.uint8:
+        # 16 bit microscope and scanner frames (PIL reads some as 32 bit ints), keep the top 8 bits
+        frame = (np.clip(frame, 0, 65535) >> 8).astype(np.uint8)
+    elif frame.dtype.kind == "f":
+        frame = (np.clip(frame, 0, 1) * 255).astype(np.uint8)
+    elif frame.dtype == bool:
+        frame = frame.astype(np.uint8) * 255
+    image = Image.fromarray(frame)
+    image = image.convert("RGB" if pix_fmt == "rgb24" else "L")
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    return np.asarray(image)
+
+
+class SequenceReader:
+    """Drop-in for VideoReader that reads the frames of an image sequence.
+
+    The files are decoded and scaled by a pool of ``threads`` threads (PIL
+    releases the GIL while decoding), up to two frames per thread ahead of
+    the reader.
+    """
+
+    def __init__(self, path, height=320, info=None, frame_limit=-1, threads=0, start_frame=0, pix_fmt="rgb24"):
+        self.info = info or probe_sequence(path)
+        self.width, self.height = scaled_size(self.info["width"], self.info["height"], height)
+        self.pix_fmt = pix_fmt
+        self.shape = (self.height, self.width, 3) if pix_fmt == "rgb24" else (self.height, self.width)
+        self.frame_bytes = int(np.prod(self.shape))
+        self.files = self.info["files"][start_frame:]
+        if frame_limit != -1:
+            self.files = self.files[:frame_limit]
+        self.threads = threads or min(8, os.cpu_count() or 1)
+        self.pool = None
+        self.pending = deque()
+        self.next_file = 0
+
+    def open(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.threads)
+        return self
+
+    def readinto(self, buffer):
+        self.open()
+        while self.next_file < len(self.files) and len(self.pending) < self.threads * 2:
+            self.pending.append(self.pool.submit(load_frame, self.files[self.next_file],
+                                                 (self.width, self.height), self.pix_fmt))
+            self.next_file += 1
+        if not self.pending:
+            return False
+        frame = self.pending.popleft().result()
+        np.copyto(np.frombuffer(memoryview(buffer).cast("B"), dtype=np.uint8).reshape(self.shape), frame)
+        return True
+
+    def __iter__(self):
+        while True:
+            frame = np.empty(self.shape, dtype=np.uint8)
+            if not self.readinto(frame):
+                break
+            yield frame
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_sequence(masks, pattern, size=None, threads=0, start_number=0, profiler=None):
+    """Save ``masks`` as numbered images, ``pattern`` being a printf pattern
+    like ``mask_%05d.png``, scaled to ``size`` when given. Encoding runs on a
+    pool of threads. Returns the number of images written."""
+    directory = os.path.dirname(pattern)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    threads = threads or min(8, os.cpu_count() or 1)
+
+    def save(mask, index):
+        image = Image.fromarray(mask, "L")
+        if size is not None and image.size != tuple(size):
+            with stage(profiler, "mask upsample"):
+                image = image.resize(size, Image.BILINEAR)
+        with stage(profiler, "encode"):
+            image.save(pattern % index)
+
+    count = 0
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        for mask in masks:
+            # the masks are reused by the pipeline, so hand the threads a copy
+            pending.append(pool.submit(save, np.array(mask), start_number + count))
+            count += 1
+            if len(pending) >= threads * 2:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+    return count
@@ -0,0 +1,136 @@
+"""Serve framed image requests (see protocol.py) from stdin to stdout, and
+answer batches of them for the daemon."""
+import base64
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .bg import cutout_image, get_model, load_image
+from .protocol import OPTIONS, MalformedMessage, read_message, write_message
+from .u2net import detect
+
+
+def attempt(function, *args):
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, e
+
+
+def handle(requests, pool, defaults):
+    """Answer a batch of (header, payload) requests with (header, payload)
+    results in the same order.
+
+    The images are decoded and the cutouts made on ``pool``, and requests
+    for the same model go through the model together. ``defaults`` are the
+    OPTIONS of requests that don't set them.
+    """
+    def decode(i):
+        header, payload = requests[i]
+        if "path" in header:
+            with open(header["path"], "rb") as f:
+                payload = f.read()
+        if isinstance(options[i].get("background_image"), str):
+            options[i]["background_image"] = np.asarray(load_image(base64.b64decode(options[i]["background_image"])))
+        return load_image(payload)
+
+    options = []
+    for header, _ in requests:
+        option = dict(defaults)
+        option.update((name, header[name]) for name in OPTIONS if name in header)
+        options.append(option)
+
+    decoded = list(pool.map(lambda i: attempt(decode, i), range(len(requests))))
+    masks = [(None, error) for _, error in decoded]
+    for model_name in {option.get("model", "u2net") for option in options}:
+        indexes = [i for i, option in enumerate(options)
+                   if option.get("model", "u2net") == model_name and decoded[i][1] is None]
+        if not indexes:
+            continue
+        predicted, error = attempt(detect.predict_many, get_model(model_name),
+                                   [np.array(decoded[i][0]) for i in indexes])
+        for n, i in enumerate(indexes):
+            masks[i] = (predicted[n].convert("L"), None) if error is None else (None, error)
+
+    def cutout(i):
+        (image, _), (mask, error) = decoded[i], masks[i]
+        if error is not None:
+            raise error
+        option = {name: value for name, value in options[i].items() if name != "model"}
+        if option.get("background_color") is not None:
+            option["background_color"] = tuple(option["background_color"])
+        data = cutout_image(image, mask, **option)
+        output = requests[i][0].get("output")
+        if output is not None:
+            with open(output, "wb") as f:
+                f.write(data)
+            return {"output": output}, b""
+        return {}, bytes(data)
+
+    results = []
+    cutouts = pool.map(lambda i: attempt(cutout, i), range(len(requests)))
+    for (header, _), (result, error) in zip(requests, cutouts):
+        if error is not None:
+            result = ({"error": str(error)}, b"")
+        if "id" in header:
+            result[0]["id"] = header["id"]
+        results.append(result)
+    return results
+
+
+def serve(stdin, stdout, framing="length", batch_size=4, threads=0, **defaults):
+    """Answer the requests on ``stdin`` on ``stdout`` until ``stdin`` ends.
+
+    Requests that are already waiting are handled as one batch of up to
+    ``batch_size``, so a client that sends ahead gets the throughput of
+    batched inference and one that waits for every result is not held up.
+    The model stays loaded for the lifetime of the process.
+    """
+    if isinstance(defaults.get("background_image"), (bytes, bytearray, memoryview)):
+        # decode the background once instead of for every image
+        defaults["background_image"] = np.asarray(load_image(defaults["background_image"]))
+    get_model(defaults.get("model", "u2net"))
+
+    requests = queue.Queue(maxsize=batch_size * 2)
+
+    def read():
+        try:
+            while True:
+                try:
+                    message = read_message(stdin, framing)
+                except MalformedMessage as e:
+                    # answered in its turn, the requests after it are still read
+                    requests.put(e)
+                    continue
+                if message is None:
+                    break
+                requests.put(message)
+        except Exception as e:
+            print(F"Could not read a request: {e}")
+        finally:
+            requests.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    with ThreadPoolExecutor(threads or min(8, os.cpu_count() or 1)) as pool:
+        finished = False
+        while not finished:
+            batch = [requests.get()]
+            while len(batch) < batch_size and batch[-1] is not None:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                finished = True
+            if not batch:
+                continue
+            messages = [item for item in batch if not isinstance(item, MalformedMessage)]
+            answers = iter(handle(messages, pool, defaults) if messages else [])
+            for item in batch:
+                if isinstance(item, MalformedMessage):
+                    write_message(stdout, {"error": F"Malformed request: {item}"}, b"", framing)
+                else:
+                    write_message(stdout, *next(answers), framing)
+            stdout.flush()
@@ -0,0 +1,109 @@
+import json
+import sys
+import time
+import torch.multiprocessing as multiprocessing
+
+
+class Telemetry:
+    """Periodic JSON lines about the throughput of every stage of the video
+    pipeline, written to stderr (``"-"``) and/or files.
+
+    The frame ripper and the workers count into shared memory, the process
+    that feeds the encoder turns the counters into a record every
+    ``interval`` seconds: decode, inference and encode frame rates since the
+    last record, the batch latency of every worker and how many frames wait
+    in the frame and mask buffers. A stage that runs at the rate of the whole
+    job while the buffer in front of it is full is the bottleneck.
+    """
+
+    def __init__(self, outputs=("-",), interval=5.0):
+        self.outputs = list(outputs)
+        self.interval = interval
+        self.streams = None
+        self.worker_nodes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["streams"] = None
+        return state
+
+    def start(self, file_path, worker_nodes, frame_slots, mask_slots):
+        """Reset the counters for a new video, before the pipeline processes are started."""
+        self.file_path = file_path
+        self.worker_nodes = worker_nodes
+        self.frame_slots = frame_slots
+        self.mask_slots = mask_slots
+        self.decoded = multiprocessing.RawValue('q', 0)
+        self.worker_frames = multiprocessing.RawArray('q', worker_nodes)
+        self.worker_batches = multiprocessing.RawArray('q', worker_nodes)
+        self.worker_seconds = multiprocessing.RawArray('d', worker_nodes)
+        self.started = self.last_time = time.time()
+        self.last = self.snapshot(0)
+
+    def frame_decoded(self, count):
+        self.decoded.value = count
+
+    def batch_done(self, worker_index, frames, seconds):
+        self.worker_frames[worker_index] += frames
+        self.worker_batches[worker_index] += 1
+        self.worker_seconds[worker_index] += seconds
+
+    def snapshot(self, encoded):
+        return {
+            "decoded": self.decoded.value,
+            "worker_frames": list(self.worker_frames),
+            "worker_batches": list(self.worker_batches),
+            "worker_seconds": list(self.worker_seconds),
+            "encoded": encoded,
+        }
+
+    def tick(self, encoded, force=False):
+        """Write a record if ``interval`` seconds passed since the last one."""
+        now = time.time()
+        if not force and now - self.last_time < self.interval:
+            return
+        current = self.snapshot(encoded)
+        last, elapsed = self.last, max(now - self.last_time, 1e-9)
+
+        workers = []
+        for i in range(self.worker_nodes):
+            batches = current["worker_batches"][i] - last["worker_batches"][i]
+            seconds = current["worker_seconds"][i] - last["worker_seconds"][i]
+            workers.append({
+                "worker": i,
+                "fps": round((current["worker_frames"][i] - last["worker_frames"][i]) / elapsed, 2),
+                "batch_latency": round(seconds / batches, 4) if batches else None,
+            })
+        masked = sum(current["worker_frames"])
+        self.write({
+            "time": round(now, 3),
+            "elapsed": round(now - self.started, 3),
+            "file": self.file_path,
+            "decoded": current["decoded"],
+            "decode_fps": round((current["decoded"] - last["decoded"]) / elapsed, 2),
+            "inference_fps": round((masked - sum(last["worker_frames"])) / elapsed, 2),
+            "workers": workers,
+            "encoded": encoded,
+            "encode_fps": round((encoded - last["encoded"]) / elapsed, 2),
+            # decoded frames waiting for or in inference, and masks waiting for the encoder;
+            # a batch is counted just after its masks are out, hence the clamping
+            "frame_buffer": max(0, current["decoded"] - masked),
+            "frame_buffer_slots": self.frame_slots,
+            "mask_buffer": max(0, masked - encoded),
+            "mask_buffer_slots": self.mask_slots,
+        })
+        self.last, self.last_time = current, now
+
+    def write(self, record):
+        if self.streams is None:
+            self.streams = [sys.stderr if output == "-" else open(output, "a") for output in self.outputs]
+        line = json.dumps(record)
+        for stream in self.streams:
+            stream.write(line + "\n")
+            stream.flush()
+
+    def close(self):
+        for stream in self.streams or []:
+            if stream is not sys.stderr:
+                stream.close()
+        self.streams = None
@@ -9,6 +9,7 @@ from torchvision import transforms
 
 from . import data_loader, u2net
 from .. import github
+from ..profiler import stage
 
 
 def load_model(model_name: str = "u2net"):
@@ -124,7 +125,7 @@ def norm_pred(d):
     return dn
 
 
-def preprocess(image):
+def preprocess(image, size=320):
     label_3 = np.zeros(image.shape)
     label = np.zeros(label_3.shape[0:2])
 
@@ -140,17 +141,21 @@ def preprocess(image):
         label = label[:, :, np.newaxis]
 
     transform = transforms.Compose(
-        [data_loader.RescaleT(320), data_loader.ToTensorLab(flag=0)]
+        [data_loader.RescaleT(size), data_loader.ToTensorLab(flag=0)]
     )
     sample = transform({"imidx": np.array([0]), "image": image, "label": label})
 
     return sample
 
 
-def predict(net, item):
-    sample = preprocess(item)
+def predict(net, item, profiler=None, size=320):
+    """The mask of the image array ``item`` as a ``size`` x ``size`` RGB
+    PIL image. The model is trained on 320; smaller sizes are quicker and
+    coarser."""
+    with stage(profiler, "preprocess"):
+        sample = preprocess(item, size)
 
-    with torch.no_grad():
+    with torch.no_grad(), stage(profiler, "inference"):
 
         if torch.cuda.is_available():
             inputs_test = torch.cuda.FloatTensor(
@@ -165,10 +170,36 @@ def predict(net, item):
         predict = norm_pred(pred)
 
         predict = predict.squeeze()
-        predict_np = predict.cpu().detach().numpy()
+        # float, also when run under reduced precision autocast
+        predict_np = predict.float().cpu().detach().numpy()
         img = Image.fromarray(predict_np * 255).convert("RGB")
 
         del d1, d2, d3, d4, d5, d6, d7, pred, predict, predict_np, inputs_test, sample
         torch.cuda.empty_cache() if torch.cuda.is_available() else None
 
         return img
+
+
+def predict_many(net, items, profiler=None, size=320):
+    """predict() for a list of images in one forward pass. The images are
+    scaled to the same network input and normalised one by one, so the masks
+    are the same as from predict()."""
+    with stage(profiler, "preprocess"):
+        samples = [preprocess(item, size) for item in items]
+
+    with torch.no_grad(), stage(profiler, "inference"):
+        inputs_test = torch.stack([sample["image"] for sample in samples]).float()
+        if torch.cuda.is_available():
+            inputs_test = inputs_test.cuda()
+
+        d1, d2, d3, d4, d5, d6, d7 = net(inputs_test)
+
+        images = []
+        for pred in d1[:, 0, :, :]:
+            predict_np = norm_pred(pred).float().cpu().detach().numpy()
+            images.append(Image.fromarray(predict_np * 255).convert("RGB"))
+
+        del d1, d2, d3, d4, d5, d6, d7, inputs_test, samples
+        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+        return images
@@ -1,64 +1,558 @@
 import os
 import math
+import shutil
+import sys
+import time
 import torch.multiprocessing as multiprocessing
 import subprocess as sp
-import time
-import ffmpeg
+from fractions import Fraction
 import numpy as np
 import torch
-from .bg import DEVICE, Net, iter_frames, remove_many
-import tempfile
+from .bg import DEVICE, Net, remove_many, remove_many_roi
+from .checkpoint import Checkpoint
+from .cpu import set_thread_budget
+from .framering import FrameRing
+from .profiler import stage
+from .sequence import SequenceReader, probe_sequence, sequence_input, write_sequence
+from .video import MATTE_ENCODERS, VideoReader, parse_position, probe_video, scaled_size, seek_args
 import requests
-from pathlib import Path
 
 multiprocessing.set_start_method('spawn', force=True)
 
 
-def worker(worker_nodes,
-           worker_index,
-           result_dict,
-           model_name,
-           gpu_batchsize,
-           total_frames,
-           frames_dict):
-    print(F"WORKER {worker_index} ONLINE")
-
-    output_index = worker_index + 1
-    base_index = worker_index * gpu_batchsize
-    net = Net(model_name)
-    script_net = None
-    for fi in (list(range(base_index + i * worker_nodes * gpu_batchsize,
-                          min(base_index + i * worker_nodes * gpu_batchsize + gpu_batchsize, total_frames)))
-               for i in range(math.ceil(total_frames / worker_nodes / gpu_batchsize))):
-        if not fi:
+def worker(worker_index,
+           tasks,
+           current,
+           started,
+           frame_ring,
+           mask_ring,
+           net,
+           shapes,
+           roi=False,
+           roi_padding=0.5,
+           retry=None,
+           worker_nodes=1,
+           threads=0,
+           pin=None,
+           telemetry=None,
+           profiler=None):
+    threads = set_thread_budget(worker_index, worker_nodes, threads, pin)
+    print(F"WORKER {worker_index} ONLINE ({threads} THREADS)")
+    if profiler is not None:
+        profiler.process = F"worker {worker_index}"
+
+    # traced once per frame size, the videos of a batch can differ
+    script_nets = {}
+    # the region of interest is tracked per worker from its previous batch of the same video
+    roi_box, roi_video = None, None
+    while True:
+        # a restarted worker first redoes the batch its predecessor lost, then
+        # idle workers take the next batch so a slow one never holds up the others
+        task, retry = (retry, None) if retry is not None else (tasks.get(), None)
+        if task is None:
             break
-
-        # are we processing frames faster than the frame ripper is saving them?
-        last = fi[-1]
-        while last not in frames_dict:
-            time.sleep(0.1)
-
-        input_frames = [frames_dict[index] for index in fi]
-        if script_net is None:
-            script_net = torch.jit.trace(net,
-                                         torch.as_tensor(np.stack(input_frames), dtype=torch.float32, device=DEVICE))
-
-        result_dict[output_index] = remove_many(input_frames, script_net)
-
-        # clean up the frame buffer
-        for fdex in fi:
-            del frames_dict[fdex]
-        output_index += worker_nodes
-
-
-def capture_frames(file_path, frames_dict, prefetched_samples, total_frames):
+        # let the supervisor know which batch this worker holds and since when
+        started[worker_index] = time.time()
+        current[3 * worker_index + 1] = task[1]
+        current[3 * worker_index + 2] = task[2]
+        current[3 * worker_index] = task[0]
+
+        start, end, video = task
+        height, width = shapes[video]
+        fi = range(start, end)
+        input_frames = [frame_ring.get(index)[:height * width * 3].reshape(height, width, 3) for index in fi]
+
+        if roi:
+            if video != roi_video:
+                roi_box, roi_video = None, video
+            # crops change size from batch to batch, so they can't use the traced net
+            with stage(profiler, "inference"):
+                masks, roi_box = remove_many_roi(input_frames, net, roi_box, roi_padding)
+        else:
+            script_net = script_nets.get((height, width))
+            if script_net is None:
+                with stage(profiler, "trace"):
+                    script_net = script_nets[(height, width)] = torch.jit.trace(
+                        net, torch.as_tensor(np.stack(input_frames), dtype=torch.float32, device=DEVICE))
+
+            # the net scales the frames to its input and the masks back up itself
+            with stage(profiler, "inference"):
+                masks = remove_many(input_frames, script_net)
+
+        for index, mask in zip(fi, masks):
+            np.copyto(mask_ring.reserve(index)[:height * width], mask.reshape(-1))
+            mask_ring.commit(index)
+        if telemetry is not None:
+            telemetry.batch_done(worker_index, len(fi), time.time() - started[worker_index])
+
+        # only hand the frames back once their masks are out, so a batch that
+        # has to be redone still finds its frames
+        current[3 * worker_index] = -1
+        for index in fi:
+            frame_ring.release(index)
+    if profiler is not None:
+        profiler.flush()
+
+
+class WorkerPool:
+    """The inference workers of a video job, supervised by the process that
+    consumes the masks.
+
+    check() finds workers that died or spent more than ``batch_timeout``
+    seconds on a batch, and restarts them with the batch they held, which is
+    redone before any new one. After ``max_restarts`` restarts the job fails
+    instead of limping on.
+    """
+
+    def __init__(self, worker_nodes, frame_ring, mask_ring, net, shapes, roi=False, roi_padding=0.5,
+                 batch_timeout=600, max_restarts=3, threads=0, pin=None, telemetry=None, profiler=None):
+        self.tasks = multiprocessing.Queue()
+        # start frame, end frame and video of the batch each worker holds, start -1 when idle
+        self.current = multiprocessing.RawArray('q', [-1] * (3 * worker_nodes))
+        self.started = multiprocessing.RawArray('d', worker_nodes)
+        self.args = (frame_ring, mask_ring, net, shapes, roi, roi_padding)
+        # the thread budget and core pinning of every worker, see set_thread_budget()
+        self.settings = (worker_nodes, threads, pin, telemetry, profiler)
+        self.batch_timeout = batch_timeout
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.processes = [None] * worker_nodes
+
+    def start(self, index, retry=None):
+        # note I am deliberately not using pool
+        # we can't trust it to run all the threads concurrently (or at all)
+        process = multiprocessing.Process(target=worker,
+                                          args=(index, self.tasks, self.current, self.started) + self.args
+                                          + (retry,) + self.settings)
+        process.start()
+        self.processes[index] = process
+
+    def start_all(self):
+        for index in range(len(self.processes)):
+            self.start(index)
+
+    def check(self):
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            batch_start = self.current[3 * index]
+            stuck = (self.batch_timeout and batch_start != -1
+                     and now - self.started[index] > self.batch_timeout)
+            if (process.is_alive() and not stuck) or process.exitcode == 0:
+                continue
+
+            if stuck:
+                print(F"WORKER {index} TIMED OUT ON FRAMES {batch_start}-{self.current[3 * index + 1]}")
+                process.terminate()
+                process.join()
+            else:
+                print(F"WORKER {index} DIED (exit code {process.exitcode})")
+            if self.restarts >= self.max_restarts:
+                raise Exception(F"Worker {index} failed and the limit of {self.max_restarts} worker restarts "
+                                F"was reached, giving up")
+            self.restarts += 1
+
+            retry = None
+            if batch_start != -1:
+                retry = (batch_start, self.current[3 * index + 1], self.current[3 * index + 2])
+                self.current[3 * index] = -1
+            self.start(index, retry)
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def capture_frames(jobs, frame_ring, mask_ring, tasks, video_ends, worker_nodes, gpu_batchsize, telemetry=None,
+                   profiler=None):
     print(F"WORKER FRAMERIPPER ONLINE")
-    for idx, frame in enumerate(iter_frames(file_path)):
-        frames_dict[idx] = frame
-        while len(frames_dict) > prefetched_samples:
-            time.sleep(0.1)
-        if idx > total_frames:
-            break
+    if profiler is not None:
+        profiler.process = "frame reader"
+    # frames are numbered on across the videos, batches never span two of them
+    count = 0
+    for video, (file_path, job) in enumerate(jobs):
+        first, total_frames = count, job["total_frames"]
+        frame_limit = total_frames if total_frames != sys.maxsize else -1
+        frame_bytes = job["height"] * job["width"] * 3
+        open_reader = SequenceReader if "files" in job["info"] else VideoReader
+        with open_reader(file_path, job["frame_height"], info=job["info"], frame_limit=frame_limit,
+                         start_frame=job["start_frame"]) as reader:
+            # decode straight into the shared frame slots
+            while count - first < total_frames:
+                # waits for a free slot first, which is not decoding time
+                slot = frame_ring.reserve(count)[:frame_bytes]
+                with stage(profiler, "decode"):
+                    decoded = reader.readinto(slot)
+                if not decoded:
+                    break
+                frame_ring.commit(count)
+                count += 1
+                if telemetry is not None:
+                    telemetry.frame_decoded(count)
+                if (count - first) % gpu_batchsize == 0:
+                    tasks.put((count - gpu_batchsize, count, video))
+        if (count - first) % gpu_batchsize:
+            tasks.put((count - (count - first) % gpu_batchsize, count, video))
+        # recorded before the first frame of the next video, see MaskPipeline.wait()
+        video_ends[video] = count
+    frame_ring.close(count)
+    mask_ring.close(count)
+    for _ in range(worker_nodes):
+        tasks.put(None)
+    if profiler is not None:
+        profiler.flush()
+
+
+def open_video(file_path, frame_limit=-1, framerate=-1, roi=False, start=None, end=None, sequence=False):
+    """Probe ``file_path`` and work out the frame range, rate and size of
+    the masks the pipeline will produce for it.
+
+    ``start`` and ``end`` limit the job to a part of the video, see
+    parse_position() for the accepted formats. With ``sequence``
+    ``file_path`` is an image sequence, see sequence_files().
+    """
+    if sequence:
+        # image sequences have no frame rate of their own
+        info = probe_sequence(file_path, framerate if framerate != -1 else "25")
+        print(F"IMAGE SEQUENCE OF {info['frames']} FRAMES")
+    else:
+        info = probe_video(file_path)
+
+    start_frame = parse_position(start, info["fps"]) if start is not None else 0
+    end_frame = info["frames"]
+    if end is not None:
+        end_frame = parse_position(end, info["fps"])
+        if info["frames"]:
+            end_frame = min(end_frame, info["frames"])
+    if end_frame is not None and end_frame <= start_frame:
+        raise Exception(F"No frames to process between frame {start_frame} and frame {end_frame}")
+    if start is not None or end is not None:
+        print(F"PROCESSING FROM FRAME {start_frame} TO {end_frame if end_frame is not None else 'the end'}")
+
+    # without a frame count in the container we decode until the stream ends
+    total_frames = end_frame - start_frame if end_frame is not None else sys.maxsize
+    if frame_limit != -1:
+        total_frames = min(frame_limit, total_frames)
+
+    if framerate == -1:
+        print(F"FRAME RATE DETECTED: {info['framerate']} (if this looks wrong, override the frame rate)")
+        framerate = info["framerate"]
+
+    print(F"FRAME RATE: {framerate} TOTAL FRAMES: {total_frames if total_frames != sys.maxsize else 'unknown'}")
+
+    # with ROI tracking the network sees a crop, so decode at full resolution
+    # to get more detail into the 320px network input
+    frame_height = None if roi else 320
+    width, height = scaled_size(info["width"], info["height"], frame_height)
+    return {
+        "info": info,
+        "start_frame": start_frame,
+        "total_frames": total_frames,
+        "framerate": framerate,
+        "frame_height": frame_height,
+        "width": width,
+        "height": height,
+    }
+
+
+def open_videos(file_paths, frame_limit=-1, framerate=-1, roi=False, start=None, end=None, sequence=False):
+    """open_video() for every file of a batch, as (path, job) pairs for MaskPipeline."""
+    return [(file_path, open_video(file_path, frame_limit, framerate, roi, start, end, sequence))
+            for file_path in file_paths]
+
+
+class MaskPipeline:
+    """The frame ripper and the workers making the masks of a list of videos.
+
+    The model is loaded and the workers are started once for all of
+    ``jobs``, the (path, job) pairs of open_videos(). The ripper decodes the
+    videos back to back into the same buffers, so the workers go on with the
+    first frames of the next video while the last masks of one are still
+    being encoded, and the first masks of every video after the first are
+    ready by the time they are asked for.
+
+    masks() has to be called in the order of ``jobs``. Videos that are passed
+    over are dropped, as is the rest of a video whose consumer stops early.
+    """
+
+    def __init__(self, jobs,
+                 worker_nodes,
+                 gpu_batchsize,
+                 model_name,
+                 prefetched_batches=4,
+                 roi=False,
+                 roi_padding=0.5,
+                 batch_timeout=600,
+                 max_restarts=3,
+                 threads=0,
+                 pin=None,
+                 telemetry=None,
+                 profiler=None):
+        self.jobs = list(jobs)
+        self.worker_nodes = worker_nodes
+        self.gpu_batchsize = gpu_batchsize
+        self.model_name = model_name
+        self.prefetched_batches = prefetched_batches
+        self.roi = roi
+        self.roi_padding = roi_padding
+        self.batch_timeout = batch_timeout
+        self.max_restarts = max_restarts
+        self.threads = threads
+        self.pin = pin
+        self.telemetry = telemetry
+        self.profiler = profiler
+        self.ripper = None
+        # the next video to hand out and the index of its first frame
+        self.next_video = 0
+        self.next_index = 0
+
+    def job(self, file_path):
+        for path, job in self.jobs[self.next_video:]:
+            if path == file_path:
+                return job
+        raise Exception(F"{file_path} is not one of the videos left in the batch")
+
+    def start(self):
+        if self.ripper is not None:
+            return
+        # the slots fit the largest frame, smaller ones use the start of a slot;
+        # enough slots for every worker to hold a batch while the ripper reads ahead,
+        # and one extra batch of masks so a finished batch never waits on a slower one
+        frame_bytes = max(job["height"] * job["width"] for _, job in self.jobs)
+        frame_slots = self.gpu_batchsize * max(self.prefetched_batches, self.worker_nodes + 1)
+        self.frame_ring = FrameRing(frame_slots, (frame_bytes * 3,))
+        self.mask_ring = FrameRing(frame_slots + self.gpu_batchsize, (frame_bytes,))
+        # index after the last frame of every video once the ripper is done with it
+        self.video_ends = multiprocessing.RawArray('q', [-1] * len(self.jobs))
+        if self.telemetry is not None:
+            self.telemetry.start(self.jobs[0][0], self.worker_nodes, self.frame_ring.slots, self.mask_ring.slots)
+
+        # load the weights once and hand the same shared memory to every worker,
+        # instead of each worker reading and holding its own copy
+        with stage(self.profiler, "load model"):
+            net = Net(self.model_name)
+            net.share_memory()
+        if self.profiler is not None:
+            self.profiler.share()
+        self.pool = WorkerPool(self.worker_nodes, self.frame_ring, self.mask_ring, net,
+                               [(job["height"], job["width"]) for _, job in self.jobs],
+                               self.roi, self.roi_padding, self.batch_timeout, self.max_restarts,
+                               self.threads, self.pin, self.telemetry, self.profiler)
+        self.ripper = multiprocessing.Process(target=capture_frames,
+                                              args=(self.jobs, self.frame_ring, self.mask_ring, self.pool.tasks,
+                                                    self.video_ends, self.worker_nodes, self.gpu_batchsize,
+                                                    self.telemetry, self.profiler))
+        self.ripper.start()
+        self.pool.start_all()
+
+    def wait(self, index, video):
+        """Wait for the mask of frame ``index``, supervising the workers in
+        the meantime. Returns None when ``video`` ended before ``index``."""
+        while True:
+            if 0 <= self.video_ends[video] <= index:
+                return None
+            try:
+                mask = self.mask_ring.get(index, timeout=1)
+                break
+            except TimeoutError:
+                pass
+            if not self.ripper.is_alive() and self.ripper.exitcode != 0:
+                raise Exception(F"The frame reader failed (exit code {self.ripper.exitcode})")
+            self.pool.check()
+            if self.telemetry is not None:
+                self.telemetry.tick(index)
+        # the mask may be the first of the next video; the ripper records the
+        # end of a video before it decodes the next one, so this can't miss it
+        if 0 <= self.video_ends[video] <= index:
+            return None
+        return mask
+
+    def drop(self):
+        """Throw away the remaining masks of the next video."""
+        while self.wait(self.next_index, self.next_video) is not None:
+            self.mask_ring.release(self.next_index)
+            self.next_index += 1
+        self.next_video += 1
+
+    def masks(self, file_path):
+        """Yield the masks of ``file_path`` in frame order, see iter_masks()."""
+        self.job(file_path)
+        self.start()
+        while self.jobs[self.next_video][0] != file_path:
+            self.drop()
+        video = self.next_video
+        job = self.jobs[video][1]
+        if self.telemetry is not None:
+            self.telemetry.file_path = file_path
+
+        first = self.next_index
+        try:
+            while self.next_index - first < job["total_frames"]:
+                # time spent waiting on the workers
+                with stage(self.profiler, "wait"):
+                    mask = self.wait(self.next_index, video)
+                if mask is None:
+                    break
+                yield mask[:job["height"] * job["width"]].reshape(job["height"], job["width"])
+                self.mask_ring.release(self.next_index)
+                self.next_index += 1
+                if self.telemetry is not None:
+                    self.telemetry.tick(self.next_index)
+        except GeneratorExit:
+            if video + 1 < len(self.jobs):
+                # the consumer stopped early, the next video is queued behind the rest of this one
+                self.drop()
+            raise
+        self.next_video += 1
+
+        if self.next_video == len(self.jobs):
+            self.ripper.join()
+            self.pool.join()
+            if self.telemetry is not None:
+                self.telemetry.tick(self.mask_ring.end, force=True)
+
+    def close(self):
+        if self.ripper is None:
+            return
+        # only still running if the consumers stopped early or something failed
+        if self.ripper.is_alive():
+            self.ripper.terminate()
+            self.ripper.join()
+        self.pool.terminate()
+        self.frame_ring.unlink()
+        self.mask_ring.unlink()
+        self.ripper = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_masks(file_path, job,
+               worker_nodes,
+               gpu_batchsize,
+               model_name,
+               prefetched_batches=4,
+               roi=False,
+               roi_padding=0.5,
+               batch_timeout=600,
+               max_restarts=3,
+               threads=0,
+               pin=None,
+               telemetry=None,
+               profiler=None):
+    """Run the frame ripper and the workers and yield the masks in frame order.
+
+    The ripper queues a batch as soon as its frames are decoded and idle
+    workers pull from that queue. The mask ring doubles as the reorder buffer:
+    masks are stored at their frame index in whatever order the batches finish
+    and read back in frame order. Each mask is a view into shared memory that
+    is only valid until the next one is requested.
+
+    While waiting for masks the workers are supervised, see WorkerPool.
+    ``threads`` and ``pin`` set the CPU share of every worker, see
+    set_thread_budget(). A Telemetry reports the throughput of the stages,
+    a Profiler records their time and memory. A batch of videos can share the workers with a MaskPipeline.
+    """
+    with MaskPipeline([(file_path, job)], worker_nodes, gpu_batchsize, model_name, prefetched_batches, roi,
+                      roi_padding, batch_timeout, max_restarts, threads, pin, telemetry, profiler) as pipeline:
+        yield from pipeline.masks(file_path)
+
+
+def resumable_masks(file_path, job, checkpoint_dir,
+                    worker_nodes,
+                    gpu_batchsize,
+                    model_name,
+                    prefetched_batches=4,
+                    roi=False,
+                    roi_padding=0.5,
+                    batch_timeout=600,
+                    max_restarts=3,
+                    threads=0,
+                    pin=None,
+                    telemetry=None,
+                    profiler=None):
+    """Like iter_masks(), but save the masks in ``checkpoint_dir`` as they
+    are made. When the job is run again with the same arguments the saved
+    masks are replayed and inference continues after the last saved chunk.
+    """
+    stat = os.stat(job["info"]["files"][-1] if "files" in job["info"] else file_path)
+    key = {
+        "input": os.path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "model": model_name,
+        # masks are normalised per batch, so the batches have to line up again
+        "gpu_batchsize": gpu_batchsize,
+        "roi": roi,
+        "roi_padding": roi_padding,
+        "start_frame": job["start_frame"],
+        "total_frames": job["total_frames"],
+        "frame_size": [job["width"], job["height"]],
+    }
+    checkpoint = Checkpoint(checkpoint_dir, key, job["width"], job["height"], job["framerate"],
+                            chunk_frames=gpu_batchsize * math.ceil(300 / gpu_batchsize))
+    done = checkpoint.completed_frames
+    if done:
+        print(F"RESUMING AFTER FRAME {done}")
+
+    for mask in checkpoint.iter_completed():
+        yield mask
+
+    if not checkpoint.finished and done < job["total_frames"]:
+        rest = dict(job, start_frame=job["start_frame"] + done, total_frames=job["total_frames"] - done)
+        masks = iter_masks(file_path, rest, worker_nodes, gpu_batchsize, model_name, prefetched_batches,
+                           roi, roi_padding, batch_timeout, max_restarts, threads, pin, telemetry, profiler)
+        for mask in checkpoint.record(masks):
+            yield mask
+
+
+def video_masks(file_path, job, checkpoint_dir=None, *args):
+    if checkpoint_dir is None:
+        return iter_masks(file_path, job, *args)
+    return resumable_masks(file_path, job, checkpoint_dir, *args)
+
+
+def mask_input(job):
+    """ffmpeg arguments that read the masks as raw gray frames from stdin."""
+    return ['-f', 'rawvideo',
+            '-vcodec', 'rawvideo',
+            '-s', F"{job['width']}x{job['height']}",
+            '-pix_fmt', 'gray',
+            '-r', F"{job['framerate']}",
+            '-i', '-']
+
+
+def pipe_masks(command, masks, profiler=None):
+    """Run the ffmpeg ``command`` and feed ``masks`` to its stdin."""
+    proc = sp.Popen(command, stdin=sp.PIPE)
+    frame_counter = 0
+    try:
+        for mask in masks:
+            # blocks while ffmpeg is busy encoding
+            with stage(profiler, "encode"):
+                proc.stdin.write(mask)
+            frame_counter = frame_counter + 1
+    except BrokenPipeError:
+        # ffmpeg stopped reading, e.g. because another input ended first with -shortest
+        pass
+    finally:
+        masks.close()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+    if proc.returncode != 0:
+        raise Exception(F"ffmpeg failed with exit code {proc.returncode}")
+    return frame_counter
 
 
 def matte_key(output, file_path,
@@ -67,110 +561,113 @@ def matte_key(output, file_path,
               model_name,
               frame_limit=-1,
               prefetched_batches=4,
-              framerate=-1):
-    manager = multiprocessing.Manager()
-
-    results_dict = manager.dict()
-    frames_dict = manager.dict()
-
-
-    info = ffmpeg.probe(file_path)
-    cmd = [
-        "ffprobe",
-        "-v",
-        "error",
-        "-select_streams",
-        "v:0",
-        "-count_packets",
-        "-show_entries",
-        "stream=nb_read_packets",
-        "-of",
-        "csv=p=0",
-        file_path
-    ]
-    framerate_output = sp.check_output(cmd, universal_newlines=True)
-
-    total_frames = int(framerate_output.split(",")[0])
-    if frame_limit != -1:
-        total_frames = min(frame_limit, total_frames)
-
-    video_stream = next((s for s in info["streams"] if s["codec_type"] == "video"), None)
-    if not video_stream:
-        raise Exception("Could not find video stream")
+              framerate=-1,
+              roi=False,
+              roi_padding=0.5,
+              checkpoint_dir=None,
+              start=None,
+              end=None,
+              batch_timeout=600,
+              max_restarts=3,
+              threads=0,
+              pin=None,
+              telemetry=None,
+              encoder="mpeg4",
+              pipeline=None,
+              profiler=None,
+              input_sequence=False,
+              output_sequence=False):
+    """Write the masks of ``file_path`` as a black and white video, encoded
+    with one of the MATTE_ENCODERS presets.
+
+    With ``output_sequence`` the masks are saved as an image sequence at the
+    size of the source frames instead, ``output`` being a printf pattern like
+    ``mask_%05d.png``. With ``input_sequence`` ``file_path`` is an image
+    sequence, see sequence_files().
+    With a MaskPipeline the masks come from its workers, which were set up
+    with its own options.
+    """
+    if encoder not in MATTE_ENCODERS:
+        raise Exception(F"Unknown matte encoder {encoder}, choose from {', '.join(MATTE_ENCODERS)}")
+    if pipeline is not None:
+        job = pipeline.job(file_path)
+        masks = pipeline.masks(file_path)
+    else:
+        job = open_video(file_path, frame_limit, framerate, roi, start, end, input_sequence)
+        masks = video_masks(file_path, job, checkpoint_dir, worker_nodes, gpu_batchsize, model_name,
+                            prefetched_batches, roi, roi_padding, batch_timeout, max_restarts, threads, pin,
+                            telemetry, profiler)
+    if output_sequence:
+        frame_counter = write_sequence(masks, output, (job["info"]["width"], job["info"]["height"]),
+                                       start_number=job["start_frame"], profiler=profiler)
+    else:
+        command = ['ffmpeg', '-y'] + mask_input(job) + ['-an'] + MATTE_ENCODERS[encoder] + ['%s' % output]
+        frame_counter = pipe_masks(command, masks, profiler)
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    print(F"FINISHED ALL FRAMES ({frame_counter})!")
+    return
 
-    frame_rate_str = video_stream.get("r_frame_rate", "0/0")
-    if frame_rate_str == "0/0":
-        raise Exception("Could not detect framerate of video")
 
-    if framerate == -1:
-        print(F"FRAME RATE DETECTED: {frame_rate_str} (if this looks wrong, override the frame rate)")
-        framerate = math.ceil(eval(frame_rate_str))
-
-    print(F"FRAME RATE: {framerate} TOTAL FRAMES: {total_frames}")
-
-    p = multiprocessing.Process(target=capture_frames,
-                                args=(file_path, frames_dict, gpu_batchsize * prefetched_batches, total_frames))
-    p.start()
-
-    # note I am deliberately not using pool
-    # we can't trust it to run all the threads concurrently (or at all)
-    workers = [multiprocessing.Process(target=worker,
-                                       args=(worker_nodes, wn, results_dict, model_name, gpu_batchsize, total_frames,
-                                             frames_dict))
-               for wn in range(worker_nodes)]
-    for w in workers:
-        w.start()
-
-    command = None
-    proc = None
-    frame_counter = 0
-    for i in range(math.ceil(total_frames / worker_nodes)):
-        for wx in range(worker_nodes):
-
-            hash_index = i * worker_nodes + 1 + wx
-
-            while hash_index not in results_dict:
-                time.sleep(0.1)
-
-            frames = results_dict[hash_index]
-            # dont block access to it anymore
-            del results_dict[hash_index]
-
-            for frame in frames:
-                if command is None:
-                    command = ['ffmpeg',
-                               '-y',
-                               '-f', 'rawvideo',
-                               '-vcodec', 'rawvideo',
-                               '-s', F"{frame.shape[1]}x320",
-                               '-pix_fmt', 'gray',
-                               '-r', F"{framerate}",
-                               '-i', '-',
-                               '-an',
-                               '-vcodec', 'mpeg4',
-                               '-b:v', '2000k',
-                               '%s' % output]
-
-                    proc = sp.Popen(command, stdin=sp.PIPE)
-
-                proc.stdin.write(frame.tobytes())
-                frame_counter = frame_counter + 1
-
-                if frame_counter >= total_frames:
-                    p.join()
-                    for w in workers:
-                        w.join()
-                    proc.stdin.close()
-                    proc.wait()
-                    print(F"FINISHED ALL FRAMES ({total_frames})!")
-                    return
-
-    p.join()
-    for w in workers:
-        w.join()
-    proc.stdin.close()
-    proc.wait()
-    return
+def alphamerge(output, file_path, overlay_inputs, filter_complex, output_args,
+               worker_nodes,
+               gpu_batchsize,
+               model_name,
+               frame_limit=-1,
+               prefetched_batches=4,
+               framerate=-1,
+               roi=False,
+               roi_padding=0.5,
+               checkpoint_dir=None,
+               start=None,
+               end=None,
+               batch_timeout=600,
+               max_restarts=3,
+               threads=0,
+               pin=None,
+               telemetry=None,
+               pipeline=None,
+               profiler=None,
+               input_sequence=False,
+               output_sequence=False):
+    """Composite the masks with ``file_path`` in a single ffmpeg run.
+
+    The source is input 0, the masks are piped in as input 1 and
+    ``overlay_inputs`` follow from input 2, so every file is decoded once and
+    the masks never go through a lossy intermediate file. ``{width}`` and
+    ``{height}`` in ``filter_complex`` are replaced with the source size.
+    The source is seeked exactly like the frame ripper, so with ``start``
+    the masks still line up with their frames. With a MaskPipeline the
+    masks come from its workers, see matte_key() also for the sequences.
+    """
+    if pipeline is not None:
+        job = pipeline.job(file_path)
+    else:
+        job = open_video(file_path, frame_limit, framerate, roi, start, end, input_sequence)
+    filter_complex = filter_complex.format(width=job["info"]["width"], height=job["info"]["height"])
+    if frame_limit != -1 or end is not None:
+        # the filters keep going on the last mask, so cut the output where the masks end
+        output_args = output_args + ['-t', str(float(job["total_frames"] / Fraction(job["framerate"])))]
+    if output_sequence:
+        # image sequences are numbered by source frame
+        output_args = output_args + ['-start_number', str(job["start_frame"])]
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+    source = seek_args(job["start_frame"], job["info"]["fps"])
+    source += sequence_input(job["info"]) if "files" in job["info"] else ['-i', file_path]
+    command = (['ffmpeg', '-y'] + source + mask_input(job) + overlay_inputs
+               + ['-filter_complex', filter_complex] + output_args + ['-shortest', output])
+    if pipeline is not None:
+        masks = pipeline.masks(file_path)
+    else:
+        masks = video_masks(file_path, job, checkpoint_dir, worker_nodes, gpu_batchsize, model_name,
+                            prefetched_batches, roi, roi_padding, batch_timeout, max_restarts, threads, pin,
+                            telemetry, profiler)
+    print("Starting alphamerge")
+    pipe_masks(command, masks, profiler)
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    print("Process finished")
 
 
 def transparentgif(output, file_path,
@@ -179,60 +676,28 @@ def transparentgif(output, file_path,
                    model_name,
                    frame_limit=-1,
                    prefetched_batches=4,
-                   framerate=-1):
-    temp_dir = tempfile.TemporaryDirectory()
-    tmpdirname = Path(temp_dir.name)
-    temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
-    matte_key(temp_file, file_path,
-              worker_nodes,
-              gpu_batchsize,
-              model_name,
-              frame_limit,
-              prefetched_batches,
-              framerate)
-    cmd = [
-        'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-filter_complex',
-        '[1][0]scale2ref[mask][main];[main][mask]alphamerge,fps=10,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse',
-        '-shortest', output
-    ]
-
-    sp.run(cmd)
-
-    print("Process finished")
-
-    return
+                   framerate=-1,
+                   **options):
+    alphamerge(output, file_path, [],
+               '[1]scale={width}:{height}[mask];[0][mask]alphamerge,fps=10,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse',
+               [],
+               worker_nodes, gpu_batchsize, model_name, frame_limit, prefetched_batches, framerate, **options)
 
 
 def transparentgifwithbackground(output, overlay, file_path,
-                      worker_nodes,
-                      gpu_batchsize,
-                      model_name,
-                      frame_limit=-1,
-                      prefetched_batches=4,
-                      framerate=-1):
-    temp_dir = tempfile.TemporaryDirectory()
-    tmpdirname = Path(temp_dir.name)
-    temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
-    matte_key(temp_file, file_path,
-              worker_nodes,
-              gpu_batchsize,
-              model_name,
-              frame_limit,
-              prefetched_batches,
-              framerate)
-    print("Starting alphamerge")
-    cmd = [
-        'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-i', overlay, '-filter_complex',
-        '[1][0]scale2ref[mask][main];[main][mask]alphamerge[fg];[2][fg]overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2:format=auto,fps=10,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse',
-        '-shortest', output
-    ]
-    sp.run(cmd)
-    print("Process finished")
-    try:
-        temp_dir.cleanup()
-    except PermissionError:
-        pass
-    return
+                                 worker_nodes,
+                                 gpu_batchsize,
+                                 model_name,
+                                 frame_limit=-1,
+                                 prefetched_batches=4,
+                                 framerate=-1,
+                                 **options):
+    alphamerge(output, file_path, ['-i', overlay],
+               '[1]scale={width}:{height}[mask];[0][mask]alphamerge[fg];[2:v]loop=loop=-1:size=1[bg];'
+               '[bg][fg]overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2:format=auto:shortest=1,fps=10,split[s0][s1];'
+               '[s0]palettegen[p];[s1][p]paletteuse',
+               [],
+               worker_nodes, gpu_batchsize, model_name, frame_limit, prefetched_batches, framerate, **options)
 
 
 def transparentvideo(output, file_path,
@@ -241,97 +706,43 @@ def transparentvideo(output, file_path,
                      model_name,
                      frame_limit=-1,
                      prefetched_batches=4,
-                     framerate=-1):
-    temp_dir = tempfile.TemporaryDirectory()
-    tmpdirname = Path(temp_dir.name)
-    temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
-    matte_key(temp_file, file_path,
-              worker_nodes,
-              gpu_batchsize,
-              model_name,
-              frame_limit,
-              prefetched_batches,
-              framerate)
-    print("Starting alphamerge")
-    cmd = [
-        'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-filter_complex',
-        '[1][0]scale2ref[mask][main];[main][mask]alphamerge', '-c:v', 'qtrle', '-shortest', output
-    ]
-
-    sp.run(cmd)
-    print("Process finished")
-    try:
-        temp_dir.cleanup()
-    except PermissionError:
-        pass
-    return
+                     framerate=-1,
+                     **options):
+    # an output sequence is one of transparent png cutouts
+    alphamerge(output, file_path, [],
+               '[1]scale={width}:{height}[mask];[0][mask]alphamerge',
+               ['-c:v', 'png'] if options.get("output_sequence") else ['-c:v', 'qtrle'],
+               worker_nodes, gpu_batchsize, model_name, frame_limit, prefetched_batches, framerate, **options)
 
 
 def transparentvideoovervideo(output, overlay, file_path,
-                         worker_nodes,
-                         gpu_batchsize,
-                         model_name,
-                         frame_limit=-1,
-                         prefetched_batches=4,
-                         framerate=-1):
-    temp_dir = tempfile.TemporaryDirectory()
-    tmpdirname = Path(temp_dir.name)
-    temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
-    matte_key(temp_file, file_path,
-              worker_nodes,
-              gpu_batchsize,
-              model_name,
-              frame_limit,
-              prefetched_batches,
-              framerate)
-    print("Starting alphamerge")
-    cmd = [
-        'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-i', overlay, '-filter_complex',
-        '[1][0]scale2ref[mask][main];[main][mask]alphamerge[vid];[vid][2:v]scale2ref[fg][bg];[bg][fg]overlay[out]', '-map', '[out]', '-shortest', output
-    ]
-    sp.run(cmd)
-    print("Process finished")
-    try:
-        temp_dir.cleanup()
-    except PermissionError:
-        pass
-    return
+                              worker_nodes,
+                              gpu_batchsize,
+                              model_name,
+                              frame_limit=-1,
+                              prefetched_batches=4,
+                              framerate=-1,
+                              **options):
+    background = probe_video(overlay)
+    alphamerge(output, file_path, ['-i', overlay],
+               '[1]scale={width}:{height}[mask];[0][mask]alphamerge[vid];'
+               '[vid]scale=%d:%d[fg];[2:v][fg]overlay=shortest=1[out]' % (background["width"], background["height"]),
+               ['-map', '[out]'],
+               worker_nodes, gpu_batchsize, model_name, frame_limit, prefetched_batches, framerate, **options)
 
 
 def transparentvideooverimage(output, overlay, file_path,
-                         worker_nodes,
-                         gpu_batchsize,
-                         model_name,
-                         frame_limit=-1,
-                         prefetched_batches=4,
-                         framerate=-1):
-    temp_dir = tempfile.TemporaryDirectory()
-    tmpdirname = Path(temp_dir.name)
-    temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
-    matte_key(temp_file, file_path,
-              worker_nodes,
-              gpu_batchsize,
-              model_name,
-              frame_limit,
-              prefetched_batches,
-              framerate)
-    print("Scale image")
-    temp_image = os.path.abspath("%s/new.jpg" % tmpdirname)
-    cmd = [
-        'ffmpeg', '-y', '-i', overlay, '-i', file_path, '-filter_complex',
-        'scale2ref[img][vid];[img]setsar=1;[vid]nullsink', '-q:v', '2', temp_image
-    ]
-    sp.run(cmd)
-    print("Starting alphamerge")
-    cmd = [
-        'ffmpeg', '-y', '-i', temp_image, '-i', file_path, '-i', temp_file, '-filter_complex',
-        '[0:v]scale2ref=oh*mdar:ih[bg];[1:v]scale2ref=oh*mdar:ih[fg];[bg][fg]overlay=(W-w)/2:(H-h)/2:shortest=1[out]',
-        '-map', '[out]', '-shortest', output
-    ]
-    sp.run(cmd)
-    print("Process finished")
-    try:
-        temp_dir.cleanup()
-    except PermissionError:
-        pass
-    return
+                              worker_nodes,
+                              gpu_batchsize,
+                              model_name,
+                              frame_limit=-1,
+                              prefetched_batches=4,
+                              framerate=-1,
+                              **options):
+    # the image is scaled to the video and looped under it in the same graph
+    # instead of going through an intermediate jpeg
+    alphamerge(output, file_path, ['-i', overlay],
+               '[1]scale={width}:{height}[mask];[0][mask]alphamerge[fg];'
+               '[2:v]scale={width}:{height},setsar=1,loop=loop=-1:size=1[bg];[bg][fg]overlay=shortest=1[out]',
+               ['-map', '[out]'],
+               worker_nodes, gpu_batchsize, model_name, frame_limit, prefetched_batches, framerate, **options)
@@ -0,0 +1,169 @@
+import subprocess as sp
+from fractions import Fraction
+import ffmpeg
+import numpy as np
+
+# ffmpeg output options for the matte key video
+MATTE_ENCODERS = {
+    # small, lossy; blocks show up along the edges of the alpha
+    "mpeg4": ['-vcodec', 'mpeg4', '-b:v', '2000k'],
+    # lossless gray, needs a container that can hold it (.mkv, .avi, .mov)
+    "ffv1": ['-vcodec', 'ffv1', '-pix_fmt', 'gray'],
+    # lossless and fast to encode, plays in most players (.mp4, .mkv); full range
+    # yuv keeps the gray levels exact
+    "x264": ['-vcodec', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-pix_fmt', 'yuvj420p'],
+    # uncompressed raw frames (.y4m), the cheapest intermediate to write and read
+    "y4m": ['-f', 'yuv4mpegpipe', '-pix_fmt', 'gray'],
+}
+
+
+def probe_video(path):
+    """Read the size, frame rate and frame count of the first video stream
+    from the container metadata, without decoding the file.
+
+    ``frames`` is None when the container does not record it, in which case
+    the video has to be decoded until the end of the stream.
+    """
+    info = ffmpeg.probe(path)
+    stream = next((s for s in info["streams"] if s["codec_type"] == "video"), None)
+    if not stream:
+        raise Exception("Could not find video stream")
+
+    width, height = int(stream["width"]), int(stream["height"])
+    # ffmpeg applies the rotation when decoding, so report the rotated size
+    rotation = int(float(stream.get("tags", {}).get("rotate", 0)))
+    for side_data in stream.get("side_data_list", []):
+        rotation = int(float(side_data.get("rotation", rotation)))
+    if rotation % 180 != 0:
+        width, height = height, width
+
+    framerate = stream.get("r_frame_rate", "0/0")
+    if framerate == "0/0":
+        framerate = stream.get("avg_frame_rate", "0/0")
+    if framerate == "0/0":
+        raise Exception("Could not detect framerate of video")
+
+    frames = None
+    for count in (stream.get("nb_frames"),
+                  stream.get("tags", {}).get("NUMBER_OF_FRAMES"),
+                  stream.get("tags", {}).get("NUMBER_OF_FRAMES-eng")):
+        if count and int(count) > 0:
+            frames = int(count)
+            break
+
+    duration = stream.get("duration") or info.get("format", {}).get("duration")
+    return {
+        "width": width,
+        "height": height,
+        "framerate": framerate,
+        "fps": float(Fraction(framerate)),
+        "frames": frames,
+        "duration": float(duration) if duration else None,
+    }
+
+
+def scaled_size(width, height, target_height=320):
+    """Frame size after scaling to ``target_height``, keeping the width even."""
+    if target_height is None:
+        return width, height
+    return max(2, int(round(width * target_height / height / 2)) * 2), target_height
+
+
+def parse_position(value, fps):
+    """Frame index of a position in a video, given in seconds (``90.5``), as
+    a timestamp (``1:30``, ``01:01:30.5``) or as a frame number (``1500f``)."""
+    value = str(value).strip()
+    try:
+        if value.endswith("f"):
+            frame = int(value[:-1])
+        else:
+            seconds = 0.0
+            for part in value.split(":"):
+                seconds = seconds * 60 + float(part)
+            frame = int(round(seconds * fps))
+    except ValueError:
+        raise Exception(F"Invalid video position: {value}")
+    if frame < 0:
+        raise Exception(F"Invalid video position: {value}")
+    return frame
+
+
+def seek_args(start_frame, fps):
+    """ffmpeg input options that start decoding at ``start_frame``.
+
+    ffmpeg seeks to the keyframe before and decodes up to the frame. Aim half
+    a frame early so rounding in the timestamps can't skip the frame.
+    """
+    if start_frame <= 0:
+        return []
+    return ['-ss', "%.6f" % ((start_frame - 0.5) / fps)]
+
+
+class VideoReader:
+    """Decode a video into RGB (or gray) frames with a single multi-threaded ffmpeg process.
+
+    Scaling is done in the ffmpeg filter graph and frames are read as fixed
+    size rawvideo records straight into caller supplied buffers, so there is
+    no per-frame work in Python besides the read itself. ``start_frame``
+    seeks to that frame before decoding.
+    """
+
+    def __init__(self, path, height=320, info=None, frame_limit=-1, threads=0, start_frame=0, pix_fmt="rgb24"):
+        self.path = path
+        self.info = info or probe_video(path)
+        self.width, self.height = scaled_size(self.info["width"], self.info["height"], height)
+        self.pix_fmt = pix_fmt
+        self.shape = (self.height, self.width, 3) if pix_fmt == "rgb24" else (self.height, self.width)
+        self.frame_bytes = self.width * self.height * (3 if pix_fmt == "rgb24" else 1)
+        self.frame_limit = frame_limit
+        self.threads = threads
+        self.start_frame = start_frame
+        self.proc = None
+
+    def command(self):
+        cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-threads', str(self.threads)]
+        cmd += seek_args(self.start_frame, self.info["fps"])
+        cmd += ['-i', self.path, '-map', '0:v:0', '-vf', F"scale={self.width}:{self.height}"]
+        if self.frame_limit != -1:
+            cmd += ['-frames:v', str(self.frame_limit)]
+        return cmd + ['-f', 'rawvideo', '-pix_fmt', self.pix_fmt, '-']
+
+    def open(self):
+        if self.proc is None:
+            self.proc = sp.Popen(self.command(), stdout=sp.PIPE, bufsize=self.frame_bytes)
+        return self
+
+    def readinto(self, buffer):
+        """Fill ``buffer`` (any writable buffer of ``frame_bytes``) with the
+        next frame. Returns False at the end of the stream."""
+        self.open()
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < self.frame_bytes:
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def __iter__(self):
+        while True:
+            frame = np.empty(self.shape, dtype=np.uint8)
+            if not self.readinto(frame):
+                break
+            yield frame
+        self.close()
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
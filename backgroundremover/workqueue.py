@@ -0,0 +1,309 @@
+"""A queue of images in a SQLite file, worked off by any number of
+processes on any number of hosts that see the file.
+
+``backgroundremover enqueue`` adds files together with the options to
+process them with. Every ``backgroundremover work`` process claims a batch
+of jobs with a lease, renews the lease while it works on them and marks
+them done. The lease of a worker that died runs out and its jobs are
+claimed again by another one. A job that fails is retried, up to a number
+of attempts.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".heif")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    input TEXT NOT NULL UNIQUE,
+    output TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class WorkQueue:
+    """The jobs of a queue file. A job is pending, leased, done or failed."""
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # transactions are begun explicitly; the lease renewal thread shares the connection
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can't claim the same jobs
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def options(self):
+        """The options the jobs are processed with, None for a new queue."""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE name = 'options'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, jobs, options):
+        """Add (input, output) ``jobs``, those already in the queue are left
+        as they are and so are the outputs of queued jobs, should the outputs
+        be in the folder enqueued again. Returns the number of jobs added."""
+        with self.transaction() as db:
+            row = db.execute("SELECT value FROM settings WHERE name = 'options'").fetchone()
+            if row is None:
+                db.execute("INSERT INTO settings (name, value) VALUES ('options', ?)", (json.dumps(options),))
+            elif json.loads(row[0]) != options:
+                raise Exception(F"The jobs of {self.path} are processed with other options: {row[0]}")
+            outputs = {row[0] for row in db.execute("SELECT output FROM jobs")}
+            before = db.total_changes
+            now = time.time()
+            db.executemany("INSERT OR IGNORE INTO jobs (input, output, updated) VALUES (?, ?, ?)",
+                           ((input_path, output_path, now) for input_path, output_path in jobs
+                            if input_path not in outputs))
+            return db.total_changes - before
+
+    def claim(self, owner, count, lease, attempts):
+        """Lease up to ``count`` pending jobs, or jobs whose lease ran out,
+        to ``owner`` for ``lease`` seconds. Returns (id, input, output) rows."""
+        now = time.time()
+        with self.transaction() as db:
+            # a job whose worker died on every attempt, e.g. out of memory, won't come back
+            db.execute("UPDATE jobs SET state = 'failed', error = 'the lease ran out on every attempt', owner = NULL, "
+                       "updated = ? WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                       (now, now, attempts))
+            rows = db.execute("SELECT id, input, output FROM jobs WHERE state = 'pending' "
+                              "OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT ?",
+                              (now, count)).fetchall()
+            db.executemany("UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, "
+                           "attempts = attempts + 1, updated = ? WHERE id = ?",
+                           ((owner, now + lease, now, row[0]) for row in rows))
+        return rows
+
+    def renew(self, owner, ids, lease):
+        with self.transaction() as db:
+            db.executemany("UPDATE jobs SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                           ((time.time() + lease, job_id, owner) for job_id in ids))
+
+    def finish(self, owner, done, errors, attempts):
+        """Mark the ids ``done`` as done, and the jobs of the {id: message}
+        ``errors`` as failed, or pending again while they have attempts left."""
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany("UPDATE jobs SET state = 'done', owner = NULL, lease_expires = NULL, error = NULL, "
+                           "updated = ? WHERE id = ?", ((now, job_id) for job_id in done))
+            db.executemany("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                           "owner = NULL, lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND owner = ?",
+                           ((attempts, message, now, job_id, owner) for job_id, message in errors.items()))
+
+    def retry_failed(self):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = 0, error = NULL, updated = ? "
+                              "WHERE state = 'failed'", (time.time(),)).rowcount
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def failures(self, limit=10):
+        with self.lock:
+            return self.db.execute("SELECT input, error FROM jobs WHERE state = 'failed' ORDER BY id LIMIT ?",
+                                   (limit,)).fetchall()
+
+
+def work(path, batch_size=16, lease=600, attempts=3, follow=False, poll=5, image_batch_size=4, threads=0,
+         memory_budget=1024 * 2 ** 20):
+    """Process the jobs of the queue ``path`` until none are left, or for
+    ever with ``follow``. See folder.process_images() for the image options."""
+    from . import folder
+
+    queue = WorkQueue(path)
+    owner = F"{socket.gethostname()}:{os.getpid()}"
+    options = None
+    processed = failed = 0
+    while True:
+        jobs = queue.claim(owner, batch_size, lease, attempts)
+        if not jobs:
+            counts = queue.counts()
+            # jobs leased by other workers may still come back, if those die
+            if not follow and not counts.get("pending") and not counts.get("leased"):
+                break
+            time.sleep(poll)
+            continue
+
+        if options is None:
+            options = queue.options()
+            if options["background_color"] is not None:
+                options["background_color"] = tuple(options["background_color"])
+            if options["background_image"] is not None:
+                with open(options["background_image"], "rb") as f:
+                    options["background_image"] = f.read()
+
+        ids = {input_path: job_id for job_id, input_path, _ in jobs}
+        done, errors = [], {}
+        for _, _, output_path in jobs:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(lease / 3):
+                queue.renew(owner, list(ids.values()), lease)
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            folder.process_images([(input_path, output_path) for _, input_path, output_path in jobs],
+                                  batch_size=image_batch_size,
+                                  threads=threads,
+                                  memory_budget=memory_budget,
+                                  done=lambda job: done.append(ids[job[0]]),
+                                  error=lambda job, e: errors.__setitem__(ids[job[0]], str(e)),
+                                  **options)
+        finally:
+            stop.set()
+            renewer.join()
+            # whatever was not finished is claimed again once the lease runs out
+            queue.finish(owner, done, errors, attempts)
+        processed += len(done)
+        failed += len(errors)
+    print(F"WORKER {owner} PROCESSED {processed} IMAGES, {failed} FAILED")
+
+
+def print_status(queue):
+    counts = queue.counts()
+    print(", ".join(F"{counts.get(state, 0)} {state}" for state in ("pending", "leased", "done", "failed")))
+    for input_path, error in queue.failures():
+        print(F"FAILED {input_path}: {error}")
+
+
+def enqueue_main(argv=None):
+    ap = argparse.ArgumentParser(prog="backgroundremover enqueue",
+                                 description="Add the images of a folder or a list to a work queue, processed by "
+                                             "backgroundremover work.")
+    ap.add_argument("queue", help="The SQLite file of the queue, made when missing. Put it where every worker sees it.")
+    ap.add_argument("-if", "--input-folder", help="Add the images of this folder.")
+    ap.add_argument("-l", "--list", help="Add the images listed in this file, one path per line, - for stdin.")
+    ap.add_argument("-of", "--output-folder",
+                    help="Folder of the outputs, the structure of the input folder is mirrored in it. "
+                         "By default the outputs go next to the inputs.")
+    ap.add_argument("-r", "--recursive", action="store_true", help="Also add the images in the subfolders.")
+    ap.add_argument("--include", action="append", help="Only add the files that match this glob. Repeatable.")
+    ap.add_argument("--exclude", action="append", help="Skip the files that match this glob. Repeatable.")
+    ap.add_argument("-m", "--model", default="u2net", choices=["u2net", "u2net_human_seg", "u2netp"])
+    ap.add_argument("-a", "--alpha-matting", action="store_true", help="Use alpha matting cutout.")
+    ap.add_argument("-af", "--alpha-matting-foreground-threshold", default=240, type=int)
+    ap.add_argument("-ab", "--alpha-matting-background-threshold", default=10, type=int)
+    ap.add_argument("-ae", "--alpha-matting-erode-size", default=10, type=int)
+    ap.add_argument("-az", "--alpha-matting-base-size", default=1000, type=int)
+    ap.add_argument("-om", "--only-mask", action="store_true", help="Output only the mask.")
+    ap.add_argument("-bc", "--background-color", default=None, help="Background color as R,G,B, e.g. 0,255,0.")
+    ap.add_argument("-bi", "--backgroundimage", default=None,
+                    help="Background image, read by every worker from this path.")
+    ap.add_argument("--retry-failed", action="store_true", help="Queue the jobs that failed again.")
+    args = ap.parse_args(argv)
+
+    queue = WorkQueue(args.queue)
+    if args.retry_failed:
+        print(F"QUEUED {queue.retry_failed()} FAILED JOBS AGAIN")
+    if not args.input_folder and not args.list:
+        if not args.retry_failed:
+            ap.error("give an --input-folder or a --list of images")
+        print_status(queue)
+        return
+
+    background_color = None
+    if args.background_color:
+        background_color = [int(x) for x in args.background_color.split(",")]
+        if len(background_color) != 3 or not all(0 <= v <= 255 for v in background_color):
+            ap.error("the background color needs three values from 0 to 255, like 0,255,0")
+    options = {
+        "model_name": args.model,
+        "alpha_matting": args.alpha_matting,
+        "alpha_matting_foreground_threshold": args.alpha_matting_foreground_threshold,
+        "alpha_matting_background_threshold": args.alpha_matting_background_threshold,
+        "alpha_matting_erode_structure_size": args.alpha_matting_erode_size,
+        "alpha_matting_base_size": args.alpha_matting_base_size,
+        "only_mask": args.only_mask,
+        "background_color": background_color,
+        "background_image": os.path.abspath(args.backgroundimage) if args.backgroundimage else None,
+    }
+
+    def output_for(input_path, relative):
+        directory, base = os.path.split(relative)
+        root = os.path.abspath(args.output_folder) if args.output_folder else os.path.dirname(input_path)
+        return os.path.join(root, directory if args.output_folder else "", F"output_{base}")
+
+    jobs = []
+    if args.input_folder:
+        from .folder import find_files
+        input_folder = os.path.abspath(args.input_folder)
+        skip_dirs = [os.path.abspath(args.output_folder)] if args.output_folder else []
+        for name in find_files(input_folder, lambda f: f.lower().endswith(IMAGE_EXTENSIONS), args.recursive,
+                               args.include, args.exclude, skip_dirs):
+            input_path = os.path.join(input_folder, name)
+            jobs.append((input_path, output_for(input_path, name)))
+    if args.list:
+        stream = sys.stdin if args.list == "-" else open(args.list)
+        with stream:
+            for line in stream:
+                if line.strip():
+                    input_path = os.path.abspath(line.strip())
+                    jobs.append((input_path, output_for(input_path, os.path.basename(input_path))))
+
+    added = queue.add(jobs, options)
+    print(F"ADDED {added} OF {len(jobs)} IMAGES TO {args.queue}")
+    print_status(queue)
+
+
+def work_main(argv=None):
+    ap = argparse.ArgumentParser(prog="backgroundremover work",
+                                 description="Process the jobs of a queue made with backgroundremover enqueue. "
+                                             "Start as many as you like, on any host that sees the queue file.")
+    ap.add_argument("queue", help="The SQLite file of the queue.")
+    ap.add_argument("-b", "--batchsize", default=16, type=int, help="Jobs to claim at once.")
+    ap.add_argument("-l", "--lease", default=600, type=float,
+                    help="Seconds a claim lasts without being renewed. A worker renews its claim while it runs, "
+                         "so this is how long the jobs of a worker that died wait before they are claimed again.")
+    ap.add_argument("--attempts", default=3, type=int, help="Times a job is tried before it counts as failed.")
+    ap.add_argument("-f", "--follow", action="store_true",
+                    help="Keep waiting for new jobs when the queue is empty instead of exiting.")
+    ap.add_argument("-ib", "--imagebatchsize", default=4, type=int, help="Images the model runs on at once.")
+    ap.add_argument("-it", "--imagethreads", default=0, type=int,
+                    help="Threads that decode and threads that encode images, 0 for one per core up to 8.")
+    ap.add_argument("-mb", "--memorybudget", default=1024, type=int,
+                    help="Memory in MB the images may take up between reading and writing.")
+    ap.add_argument("--status", action="store_true", help="Show how many jobs are in every state, and exit.")
+    args = ap.parse_args(argv)
+
+    if args.status:
+        if not os.path.exists(args.queue):
+            print(F"No queue at {args.queue}")
+            sys.exit(1)
+        print_status(WorkQueue(args.queue))
+        return
+    work(args.queue, args.batchsize, args.lease, args.attempts, args.follow,
+         image_batch_size=args.imagebatchsize, threads=args.imagethreads, memory_budget=args.memorybudget * 2 ** 20)
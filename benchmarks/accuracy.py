@@ -0,0 +1,254 @@
+"""Mask quality against speed of the inference modes, every combination of
+model, precision and network input size.
+
+A folder of images goes through every mode and the masks are compared with
+the ground truth masks in --masks (same file name, any extension) or,
+without those, with the masks of the reference mode: u2net in fp32 at 320,
+what backgroundremover runs by default. Without a folder the synthetic
+fields of synthetic.py are used, with their true cell masks as ground truth.
+
+Every mode runs in a process of its own, so its peak memory is its own.
+Models without a checkpoint are skipped instead of downloaded.
+
+    python benchmarks/accuracy.py -i photos/ --masks photo_masks/ -o report.json
+    python benchmarks/accuracy.py -i photos/ -m u2net,u2netp -p fp32,bf16 -s 320,256,192
+"""
+import argparse
+import json
+import os
+import subprocess as sp
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from backgroundremover.profiler import peak_rss  # noqa: E402
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic", ".heif")
+# reduced precision runs the model under torch.autocast
+PRECISIONS = {"fp32": None, "bf16": "bfloat16", "fp16": "float16"}
+REFERENCE = ("u2net", "fp32", 320)
+
+
+def checkpoint(model_name):
+    variable = "U2NETP_PATH" if model_name == "u2netp" else "U2NET_PATH"
+    return os.environ.get(variable, os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")))
+
+
+def mode_name(mode):
+    return "%s %s %d" % mode
+
+
+def find_images(folder, limit=0):
+    images = []
+    for name in sorted(f for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS)):
+        path = os.path.join(folder, name)
+        try:
+            with Image.open(path) as image:
+                image.verify()
+        except Exception as e:
+            print(F"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        images.append(path)
+        if len(images) == limit:
+            break
+    return images
+
+
+def find_masks(images, folder):
+    """The ground truth mask of every image, by file name without extension."""
+    masks = {os.path.splitext(f)[0]: os.path.join(folder, f) for f in os.listdir(folder)}
+    missing = [path for path in images if os.path.splitext(os.path.basename(path))[0] not in masks]
+    if missing:
+        raise Exception(F"No mask in {folder} for {', '.join(missing[:5])}")
+    return [masks[os.path.splitext(os.path.basename(path))[0]] for path in images]
+
+
+def synthetic_inputs(work_dir, count):
+    """Synthetic fields and their cell masks as files, varying in size and crowding."""
+    images, masks = [], []
+    for i in range(count):
+        width, height = list(synthetic.RESOLUTIONS.values())[i % len(synthetic.RESOLUTIONS)]
+        kind = ("sparse", "crowded")[i % 2]
+        image, mask = synthetic.field(width, height, kind, seed=i)
+        images.append(os.path.join(work_dir, "field_%03d.png" % i))
+        masks.append(os.path.join(work_dir, "field_%03d.mask.png" % i))
+        Image.fromarray(synthetic.rgb(image)).save(images[-1])
+        Image.fromarray(mask).save(masks[-1])
+    return images, masks
+
+
+def run_mode(model_name, precision, size, images, output_dir):
+    """Make the masks of ``images`` in one mode, at the size of the images,
+    and return the seconds every image took."""
+    import torch
+    from backgroundremover.bg import get_model, load_image
+    from backgroundremover.u2net import detect
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    net = get_model(model_name)
+
+    def mask_of(img):
+        with torch.autocast(device, dtype=getattr(torch, PRECISIONS[precision] or "float32"),
+                            enabled=PRECISIONS[precision] is not None):
+            if PRECISIONS[precision] is not None and not torch.is_autocast_enabled(device):
+                raise Exception(F"{precision} is not supported on {device}")
+            mask = detect.predict(net, np.array(img), size=size)
+        # scaling the mask to the image is part of the cost of a mode
+        return mask.convert("L").resize(img.size, Image.LANCZOS)
+
+    seconds = []
+    for index, path in enumerate(images):
+        with open(path, "rb") as f:
+            img = load_image(f.read())
+        if index == 0:
+            mask_of(img)
+        start = time.perf_counter()
+        mask = mask_of(img)
+        seconds.append(time.perf_counter() - start)
+        mask.save(os.path.join(output_dir, "%05d.png" % index))
+    return seconds
+
+
+def run_isolated(mode, images, work_dir):
+    output_dir = os.path.join(work_dir, mode_name(mode).replace(" ", "_"))
+    os.makedirs(output_dir, exist_ok=True)
+    listing = os.path.join(work_dir, "images.json")
+    with open(listing, "w") as f:
+        json.dump(images, f)
+    command = [sys.executable, os.path.abspath(__file__), "--run", mode_name(mode), "--images", listing,
+               "--result", output_dir]
+    proc = sp.run(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+    if proc.returncode != 0:
+        lines = proc.stdout.decode(errors="replace").strip().splitlines()
+        return {"mode": mode_name(mode), "error": lines[-1] if lines else F"exit code {proc.returncode}"}
+    with open(os.path.join(output_dir, "result.json")) as f:
+        result = json.load(f)
+    result["masks"] = [os.path.join(output_dir, "%05d.png" % i) for i in range(len(images))]
+    return result
+
+
+def compare(mask, truth):
+    """IoU of the masks cut at 50% and the mean absolute error of the alpha values, 0..1."""
+    if truth.shape != mask.shape:
+        truth = np.asarray(Image.fromarray(truth).resize(mask.shape[::-1], Image.NEAREST))
+    a, b = mask >= 128, truth >= 128
+    union = np.logical_or(a, b).sum()
+    iou = np.logical_and(a, b).sum() / union if union else 1.0
+    return float(iou), float(np.abs(mask.astype(np.float32) - truth.astype(np.float32)).mean() / 255)
+
+
+def load_mask(path):
+    return np.asarray(Image.open(path).convert("L"))
+
+
+def pareto(results):
+    """Mark the modes that no other mode beats in both speed and IoU."""
+    for result in results:
+        result["pareto"] = not any(
+            other is not result and other["median_ms"] <= result["median_ms"] and other["iou"] >= result["iou"]
+            and (other["median_ms"] < result["median_ms"] or other["iou"] > result["iou"])
+            for other in results)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-i", "--input", default=None, help="Folder of images, synthetic fields when not given.")
+    ap.add_argument("--masks", default=None, help="Folder of ground truth masks, named like the images.")
+    ap.add_argument("-n", "--limit", default=0, type=int, help="Only use the first N images (6 synthetic ones).")
+    ap.add_argument("-m", "--models", default="u2net,u2netp,u2net_human_seg", help="Comma separated models.")
+    ap.add_argument("-p", "--precisions", default="fp32,bf16", help="Comma separated, of fp32, bf16 and fp16.")
+    ap.add_argument("-s", "--sizes", default="320,256", help="Comma separated network input sizes.")
+    ap.add_argument("-o", "--output", default=None, help="Write the report to this JSON file.")
+    ap.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    ap.add_argument("--images", default=None, help=argparse.SUPPRESS)
+    ap.add_argument("--result", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        # one mode in a process of its own, see run_isolated()
+        model_name, precision, size = args.run.split()
+        with open(args.images) as f:
+            images = json.load(f)
+        seconds = run_mode(model_name, precision, int(size), images, args.result)
+        with open(os.path.join(args.result, "result.json"), "w") as f:
+            json.dump({"mode": args.run, "seconds": seconds, "peak_rss": peak_rss()}, f)
+        return
+
+    for precision in args.precisions.split(","):
+        if precision not in PRECISIONS:
+            ap.error(F"unknown precision {precision}, choose from {', '.join(PRECISIONS)}")
+    modes = [(model_name, precision, int(size)) for model_name in args.models.split(",")
+             for precision in args.precisions.split(",") for size in args.sizes.split(",")]
+    for model_name in sorted({mode[0] for mode in modes}):
+        if not os.path.exists(checkpoint(model_name)):
+            print(F"No checkpoint for {model_name} at {checkpoint(model_name)}, skipping it", file=sys.stderr)
+            modes = [mode for mode in modes if mode[0] != model_name]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.input:
+            images = find_images(args.input, args.limit)
+            truths = find_masks(images, args.masks) if args.masks else None
+        else:
+            images, truths = synthetic_inputs(work_dir, args.limit or 6)
+        if not images:
+            raise Exception(F"No images found in {args.input}")
+        if truths is None:
+            if not os.path.exists(checkpoint(REFERENCE[0])):
+                raise Exception("Without ground truth masks the reference mode needs the u2net checkpoint")
+            # first, the others are compared with it
+            modes = [REFERENCE] + [mode for mode in modes if mode != REFERENCE]
+        print(F"{len(images)} images, {len(modes)} modes, compared with "
+              F"{'the ground truth' if truths else 'the masks of ' + mode_name(REFERENCE)}", file=sys.stderr)
+
+        results = []
+        for mode in modes:
+            print(F"{mode_name(mode)}...", file=sys.stderr)
+            result = run_isolated(mode, images, work_dir)
+            if "error" in result:
+                if truths is None:
+                    raise Exception(F"The reference mode {mode_name(REFERENCE)} failed, "
+                                    F"there is nothing to compare with: {result['error']}")
+                print(F"  failed: {result['error']}", file=sys.stderr)
+                results.append(result)
+                continue
+            if truths is None and mode == REFERENCE:
+                truths = result["masks"]
+            scores = [compare(load_mask(mask), load_mask(truth)) for mask, truth in zip(result["masks"], truths)]
+            del result["masks"]
+            result.update({
+                "median_ms": float(np.median(result["seconds"])) * 1000,
+                "images_per_second": len(images) / sum(result["seconds"]),
+                "iou": float(np.mean([iou for iou, _ in scores])),
+                "min_iou": float(np.min([iou for iou, _ in scores])),
+                "mae": float(np.mean([mae for _, mae in scores])),
+            })
+            results.append(result)
+
+    done = [result for result in results if "error" not in result]
+    pareto(done)
+    print(F"{'mode':26} {'median ms':>10} {'images/s':>9} {'peak MB':>8} {'IoU':>7} {'min IoU':>8} {'MAE':>7}  best")
+    for result in results:
+        if "error" in result:
+            print(F"{result['mode']:26} {result['error']}")
+            continue
+        print(F"{result['mode']:26} {result['median_ms']:10.1f} {result['images_per_second']:9.2f} "
+              F"{result['peak_rss'] / 2 ** 20:8.1f} {result['iou']:7.4f} {result['min_iou']:8.4f} "
+              F"{result['mae']:7.4f}  {'*' if result['pareto'] else ''}")
+    print("best: no other mode is both faster and more accurate")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "images": len(images),
+                "compared_with": "ground truth" if args.masks or not args.input else mode_name(REFERENCE),
+                "results": results,
+            }, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Encode time, size and error of the matte encoder presets.
+
+Encodes the same synthetic matte (a soft edged disc moving over a black
+background) with every preset in backgroundremover.utilities.MATTE_ENCODERS,
+decodes it again and compares it with the input.
+
+    python benchmarks/matte_presets.py --frames 300 --height 720
+"""
+import argparse
+import os
+import subprocess as sp
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backgroundremover.utilities import MATTE_ENCODERS  # noqa: E402
+from backgroundremover.video import VideoReader  # noqa: E402
+
+EXTENSIONS = {"mpeg4": ".mp4", "ffv1": ".mkv", "x264": ".mp4", "y4m": ".y4m"}
+
+
+def synthetic_mattes(frames, width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    radius = height / 4
+    for i in range(frames):
+        cx = width / 4 + (width / 2) * (i % 100) / 100
+        cy = height / 2 + height / 8 * np.sin(i / 10)
+        distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+        # a few pixels of soft edge, like the model's output
+        yield np.clip((radius - distance) * 32 + 128, 0, 255).astype(np.uint8)
+
+
+def encode(preset, mattes, width, height, output):
+    command = ['ffmpeg', '-v', 'error', '-y',
+               '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', F"{width}x{height}", '-pix_fmt', 'gray',
+               '-r', '25', '-i', '-'] + MATTE_ENCODERS[preset] + [output]
+    start = time.time()
+    proc = sp.Popen(command, stdin=sp.PIPE)
+    for matte in mattes:
+        proc.stdin.write(matte)
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise Exception(F"ffmpeg failed for {preset}")
+    return time.time() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--frames", default=250, type=int)
+    ap.add_argument("--height", default=320, type=int)
+    args = ap.parse_args()
+    height = args.height
+    width = height * 16 // 9 // 2 * 2
+
+    mattes = list(synthetic_mattes(args.frames, width, height))
+    raw_size = len(mattes) * width * height
+    print(F"{args.frames} frames of {width}x{height}, {raw_size / 2 ** 20:.1f} MiB raw")
+    print(F"{'preset':8} {'encode fps':>11} {'size MiB':>9} {'ratio':>7} {'max error':>10} {'mean error':>11}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for preset in MATTE_ENCODERS:
+            output = os.path.join(work_dir, "matte" + EXTENSIONS[preset])
+            try:
+                seconds = encode(preset, mattes, width, height, output)
+            except Exception as e:
+                print(F"{preset:8} {e}")
+                continue
+            size = os.path.getsize(output)
+            info = {"width": width, "height": height, "fps": 25}
+            decoded = list(VideoReader(output, None, info=info, pix_fmt="gray"))
+            error = np.abs(np.stack(decoded).astype(int) - np.stack(mattes[:len(decoded)]).astype(int))
+            print(F"{preset:8} {len(mattes) / seconds:11.1f} {size / 2 ** 20:9.2f} {raw_size / size:7.1f} "
+                  F"{error.max():10d} {error.mean():11.3f}")
+
+
+if __name__ == "__main__":
+    main()
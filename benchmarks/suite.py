@@ -0,0 +1,287 @@
+"""Throughput and peak memory of the stages of backgroundremover on
+synthetic inputs, written as JSON so that runs can be compared over time.
+
+Every benchmark runs in a process of its own, so the peak memory of a case
+is that of its benchmark up to and including the case. The inputs come from
+synthetic.py and are the same on every run. Without model checkpoints
+(~/.u2net, U2NET_PATH, U2NETP_PATH) the model gets seeded random weights:
+the timings hold, the masks are noise. Nothing is downloaded.
+
+    python benchmarks/suite.py -o results.json
+    python benchmarks/suite.py -b predict forward -r 5 --compare results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from backgroundremover.profiler import peak_rss  # noqa: E402
+
+
+def weights(model_name, work_dir):
+    """Point the model loader at seeded random weights when there is no
+    checkpoint. Returns "checkpoint" or "random"."""
+    variable = "U2NETP_PATH" if model_name == "u2netp" else "U2NET_PATH"
+    path = os.environ.get(variable, os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")))
+    if os.path.exists(path):
+        return "checkpoint"
+    import torch
+    from backgroundremover.u2net import u2net
+    torch.manual_seed(0)
+    net = u2net.U2NETP(3, 1) if model_name == "u2netp" else u2net.U2NET(3, 1)
+    path = os.path.join(work_dir, model_name + ".pth")
+    torch.save(net.state_dict(), path)
+    # inherited by the benchmark processes
+    os.environ[variable] = path
+    return "random"
+
+
+def measure(function, items=1, repeat=3, warmup=1):
+    """Run ``function`` ``warmup`` times untimed and ``repeat`` times timed.
+    ``items`` is what one run processes, for the throughput."""
+    for _ in range(warmup):
+        function()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    median = statistics.median(seconds)
+    return {
+        "items": items,
+        "seconds": seconds,
+        "median_seconds": median,
+        "throughput": items / median,
+    }
+
+
+def images(resolutions=synthetic.RESOLUTIONS, fields=synthetic.FIELDS, bit_depths=(8,)):
+    for resolution in resolutions:
+        width, height = synthetic.RESOLUTIONS[resolution]
+        for kind in fields:
+            for bit_depth in bit_depths:
+                image, mask = synthetic.field(width, height, kind, bit_depth)
+                params = {"resolution": resolution, "field": kind}
+                if len(bit_depths) > 1:
+                    params["bit_depth"] = bit_depth
+                yield params, image, mask
+
+
+def bench_decode(args):
+    from backgroundremover.bg import load_image
+    for params, image, _ in images(bit_depths=(8, 16)):
+        data = synthetic.encode_png(image)
+        yield params, measure(lambda: load_image(data), 1, args.repeat)
+
+
+def bench_predict(args):
+    from backgroundremover.bg import get_model
+    from backgroundremover.u2net import detect
+    net = get_model(args.model)
+    # the model sees every image at 320x320, the content doesn't change its time
+    for params, image, _ in images(fields=["sparse"]):
+        item = synthetic.rgb(image)
+        yield params, measure(lambda: detect.predict(net, item), 1, args.repeat)
+
+
+def bench_forward(args):
+    from backgroundremover.bg import Net, remove_many
+    net = Net(args.model)
+    # video frames, scaled to the 320 pixel height of the frame ripper
+    image, _ = synthetic.field(568, 320, "sparse")
+    frame = synthetic.rgb(image)
+    for batch_size in (1, 2, 4, 8):
+        frames = [frame] * batch_size
+        yield {"batch_size": batch_size}, measure(lambda: remove_many(frames, net), batch_size, args.repeat)
+
+
+def bench_naive_cutout(args):
+    from PIL import Image
+    from backgroundremover.bg import naive_cutout
+    for params, image, mask in images():
+        img, mask = Image.fromarray(synthetic.rgb(image)), Image.fromarray(mask)
+        yield params, measure(lambda: naive_cutout(img, mask), 1, args.repeat)
+
+
+def bench_alpha_matting(args):
+    from PIL import Image
+    from backgroundremover.bg import alpha_matting_cutout
+    # a blank field has no foreground for the trimap, and pymatting takes
+    # long enough on the larger sizes
+    for params, image, mask in images(["hd", "fullhd"], ["sparse", "crowded"]):
+        img, mask = Image.fromarray(synthetic.rgb(image)), Image.fromarray(mask)
+        yield params, measure(lambda: alpha_matting_cutout(img.copy(), mask, 240, 10, 10, 1000), 1, args.repeat)
+
+
+def bench_png_encode(args):
+    import io
+    from PIL import Image
+    from backgroundremover.bg import naive_cutout
+
+    for params, image, mask in images():
+        cutout = naive_cutout(Image.fromarray(synthetic.rgb(image)), Image.fromarray(mask))
+        yield params, measure(lambda: cutout.save(io.BytesIO(), "PNG"), 1, args.repeat)
+
+
+def bench_server(args):
+    import requests
+    from waitress.server import create_server
+    from backgroundremover.cmd.server import app
+
+    server = create_server(app, host="127.0.0.1", port=0, threads=1)
+    threading.Thread(target=server.run, daemon=True).start()
+    url = F"http://127.0.0.1:{server.effective_port}/?model={args.model}"
+    try:
+        for params, image, _ in images(["qvga", "hd"], ["sparse"]):
+            data = synthetic.encode_png(synthetic.rgb(image))
+
+            def post():
+                response = requests.post(url, files={"file": ("field.png", data)})
+                response.raise_for_status()
+
+            # the warmup request loads the model
+            yield params, measure(post, 1, args.repeat)
+    finally:
+        server.close()
+
+
+def bench_matte_key(args):
+    from backgroundremover import utilities
+    frames = 24
+    with tempfile.TemporaryDirectory() as work_dir:
+        video = synthetic.write_video(os.path.join(work_dir, "field.mp4"), frames, 640, 360)
+        output = os.path.join(work_dir, "matte.mp4")
+        # one run is a whole job: starting the workers, loading and tracing
+        # the model; the peak memory is that of this process, not the workers
+        yield {"frames": frames, "worker_nodes": 1, "gpu_batchsize": 2}, measure(
+            lambda: utilities.matte_key(output, video, 1, 2, args.model), frames, 1, 0)
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "predict": bench_predict,
+    "forward": bench_forward,
+    "naive_cutout": bench_naive_cutout,
+    "alpha_matting": bench_alpha_matting,
+    "png_encode": bench_png_encode,
+    "server": bench_server,
+    "matte_key": bench_matte_key,
+}
+
+
+def run(name, args):
+    """The records of benchmark ``name`` in this process."""
+    records = []
+    for params, record in BENCHMARKS[name](args):
+        record = dict({"benchmark": name, "params": params}, **record)
+        record["peak_rss"] = peak_rss()
+        records.append(record)
+        print(F"  {name} {params}: {record['throughput']:.2f}/s", file=sys.stderr)
+    return records
+
+
+def run_isolated(name, args, work_dir):
+    result = os.path.join(work_dir, name + ".json")
+    command = [sys.executable, os.path.abspath(__file__), "--run", name, "--result", result,
+               "-m", args.model, "-r", str(args.repeat)]
+    proc = sp.run(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stdout.decode(errors="replace"))
+        return [{"benchmark": name, "error": F"exit code {proc.returncode}"}]
+    with open(result) as f:
+        return json.load(f)
+
+
+def environment(args, weight_source):
+    try:
+        commit = sp.run(["git", "rev-parse", "HEAD"], stdout=sp.PIPE, stderr=sp.DEVNULL,
+                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip() or None
+    except OSError:
+        commit = None
+    import torch
+    return {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cuda": torch.cuda.is_available(),
+        "model": args.model,
+        "weights": weight_source,
+        "repeat": args.repeat,
+    }
+
+
+def key(record):
+    return record["benchmark"], json.dumps(record.get("params"), sort_keys=True)
+
+
+def print_table(records, baseline=None):
+    previous = {key(record): record for record in baseline or [] if "throughput" in record}
+    print(F"{'benchmark':14} {'case':44} {'per s':>10} {'median ms':>10} {'peak MB':>9}"
+          + (F" {'vs base':>8}" if baseline else ""))
+    for record in records:
+        if "error" in record:
+            print(F"{record['benchmark']:14} {record['error']}")
+            continue
+        case = " ".join(F"{k}={v}" for k, v in record["params"].items())
+        line = (F"{record['benchmark']:14} {case:44} {record['throughput']:10.2f} "
+                F"{record['median_seconds'] * 1000:10.1f} {record['peak_rss'] / 2 ** 20:9.1f}")
+        if baseline:
+            old = previous.get(key(record))
+            line += F" {record['throughput'] / old['throughput']:7.2f}x" if old else F" {'-':>8}"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-b", "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                    help="The benchmarks to run, all by default.")
+    ap.add_argument("-m", "--model", default="u2net", choices=["u2net", "u2netp"])
+    ap.add_argument("-r", "--repeat", default=3, type=int, help="Timed runs of every case, the median counts.")
+    ap.add_argument("-o", "--output", default=None, help="Write the environment and the results to this JSON file.")
+    ap.add_argument("--compare", default=None, help="JSON file of an earlier run to compare the throughput with.")
+    ap.add_argument("--same-process", action="store_true",
+                    help="Run all benchmarks in this process, quicker but the peak memory adds up.")
+    ap.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    ap.add_argument("--result", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        # one benchmark in a process of its own, see run_isolated()
+        with open(args.result, "w") as f:
+            json.dump(run(args.run, args), f)
+        return
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        weight_source = weights(args.model, work_dir)
+        if weight_source == "random":
+            print(F"No {args.model} checkpoint found, benchmarking with random weights", file=sys.stderr)
+        records = []
+        for name in args.benchmarks:
+            print(F"{name}...", file=sys.stderr)
+            records += run(name, args) if args.same_process else run_isolated(name, args, work_dir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_table(records, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(args, weight_source), "results": records}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
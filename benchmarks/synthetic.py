@@ -0,0 +1,105 @@
+"""Deterministic synthetic inputs for the benchmarks.
+
+The images look like fluorescence microscope fields: soft, slightly uneven
+cells on a dark background with a little camera noise. The same arguments
+always give the same pixels, so runs on different days and machines see the
+same inputs. The true cell mask comes along for the benchmarks that need a
+mask without running the model.
+"""
+import io
+import subprocess as sp
+import numpy as np
+from PIL import Image
+
+# name: cells per megapixel
+FIELDS = {
+    "blank": 0,
+    "sparse": 12,
+    "crowded": 250,
+}
+
+# name: (width, height)
+RESOLUTIONS = {
+    "qvga": (320, 240),
+    "hd": (1280, 720),
+    "fullhd": (1920, 1080),
+}
+
+
+def cells(width, height, density, seed):
+    """Centre, radii and brightness of the cells of a field."""
+    rng = np.random.default_rng(seed)
+    count = int(round(density * width * height / 1e6))
+    scale = min(width, height)
+    return [(rng.uniform(0, width), rng.uniform(0, height),
+             rng.uniform(0.02, 0.06) * scale, rng.uniform(0.02, 0.06) * scale,
+             rng.uniform(0, np.pi), rng.uniform(0.5, 1.0))
+            for _ in range(count)]
+
+
+def render(width, height, field_cells, seed=0, shift=(0.0, 0.0)):
+    """The field as floats in 0..1 and the mask of the cells as bools.
+
+    Every cell is drawn on the patch around it only, so crowded full HD
+    fields stay quick to make. ``shift`` moves all cells, for video frames.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), 0.05, dtype=np.float32)
+    mask = np.zeros((height, width), dtype=bool)
+    for cx, cy, rx, ry, angle, brightness in field_cells:
+        cx, cy = cx + shift[0], cy + shift[1]
+        extent = int(max(rx, ry) * 1.5) + 1
+        top, bottom = max(int(cy) - extent, 0), min(int(cy) + extent, height)
+        left, right = max(int(cx) - extent, 0), min(int(cx) + extent, width)
+        if top >= bottom or left >= right:
+            continue
+        y, x = np.mgrid[top:bottom, left:right]
+        dx, dy = x - cx, y - cy
+        u = (dx * np.cos(angle) + dy * np.sin(angle)) / rx
+        v = (-dx * np.sin(angle) + dy * np.cos(angle)) / ry
+        distance = u ** 2 + v ** 2
+        # bright, slightly blurred body with a darker nucleus
+        cell = brightness / (1 + np.exp((distance - 1) * 12)) * (1 - 0.4 * np.exp(-distance * 8))
+        np.maximum(image[top:bottom, left:right], cell, out=image[top:bottom, left:right])
+        mask[top:bottom, left:right] |= distance < 1
+    image += rng.normal(0, 0.02, image.shape).astype(np.float32)
+    return np.clip(image, 0, 1), mask
+
+
+def field(width, height, kind="sparse", bit_depth=8, seed=0):
+    """A field of ``kind`` (see FIELDS) as an array of ``bit_depth`` 8 or
+    16, and the mask of its cells as 0/255 uint8."""
+    image, mask = render(width, height, cells(width, height, FIELDS[kind], seed), seed)
+    if bit_depth == 16:
+        image = (image * 65535).astype(np.uint16)
+    else:
+        image = (image * 255).astype(np.uint8)
+    return image, mask.astype(np.uint8) * 255
+
+
+def rgb(image):
+    """An 8 bit field as the RGB array the model takes."""
+    return np.repeat(image[:, :, None], 3, axis=2)
+
+
+def encode_png(image):
+    """A field as PNG bytes, 16 bit fields stay 16 bit."""
+    bio = io.BytesIO()
+    Image.fromarray(image).save(bio, "PNG")
+    return bio.getvalue()
+
+
+def write_video(path, frames, width, height, kind="sparse", seed=0, framerate=25):
+    """A short video of a field whose cells drift across it, encoded with mpeg4."""
+    field_cells = cells(width, height, FIELDS[kind], seed)
+    command = ['ffmpeg', '-v', 'error', '-y',
+               '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', F"{width}x{height}", '-pix_fmt', 'rgb24',
+               '-r', str(framerate), '-i', '-', '-c:v', 'mpeg4', '-q:v', '2', '-pix_fmt', 'yuv420p', path]
+    proc = sp.Popen(command, stdin=sp.PIPE)
+    for i in range(frames):
+        image, _ = render(width, height, field_cells, seed + i, shift=(i * width / 400, i * height / 800))
+        proc.stdin.write(rgb((image * 255).astype(np.uint8)).tobytes())
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise Exception(F"ffmpeg could not write {path}")
+    return path
@@ -12,7 +12,7 @@ import datetime
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
-    from backgroundremover.bg import remove
+    from backgroundremover.daemon import remove
 except ImportError:
     messagebox.showerror("Error", "Could not import backgroundremover. Make sure it is installed.")
     sys.exit(1)